@@ -5,3 +5,5 @@ __email__ = 'yixiangy@isi.edu'
 
 import ppjoin.ppjoin_ as ppjoin
 import ppjoin.p4join as p4join
+import ppjoin.sink as sink
+import ppjoin.external as external
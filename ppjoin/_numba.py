@@ -0,0 +1,284 @@
+"""
+Compiled PPJoin kernel
+
+The same filters and verification as `ppjoin_.iter_compare`, compiled with numba over the packed records.
+The inverted index is built up front in CSR form with postings sorted by record,
+so probing the postings of records before x is the same as probing the incremental index.
+Counters are accumulated into an int64 array in the order of `ppjoin_.JoinStats.COUNTERS`.
+The kernels release the GIL, so bands can be joined in a thread pool.
+Importing this module fails if numba is not installed, `ppjoin_` then falls back to pure Python.
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+SIM_CODES = {'jaccard': 0, 'cosine': 1, 'dice': 2, 'overlap': 3}
+
+
+@njit(cache=True)
+def _ceil(x):
+    # `ppjoin_.ceil`: round to 10 decimals, then round up
+    r = np.int64(round(x * 1e10))
+    return (r + 9999999999) // 10000000000
+
+
+@njit(cache=True)
+def _min_length(len_s, t, sim):
+    if sim == 0:
+        return _ceil(t * len_s)
+    if sim == 1:
+        return _ceil(t * t * len_s)
+    if sim == 2:
+        return _ceil(t / (2.0 - t) * len_s)
+    return 1
+
+
+@njit(cache=True)
+def _overlap_constraint(len_s1, len_s2, t, sim):
+    if sim == 0:
+        return _ceil(t / (1.0 + t) * (len_s1 + len_s2))
+    if sim == 1:
+        return _ceil(t * math.sqrt(len_s1 * len_s2))
+    if sim == 2:
+        return _ceil(t / 2.0 * (len_s1 + len_s2))
+    return _ceil(t * min(len_s1, len_s2))
+
+
+@njit(cache=True)
+def _prefix_lengths(len_s, t, sim):
+    """
+    Probing and indexing prefix, see `ppjoin_.prefix_length` and `ppjoin_.index_prefix_length`.
+    """
+    xp = len_s if sim == 3 else len_s - _min_length(len_s, t, sim) + 1
+    xp = min(xp, len_s)
+    xi = min(len_s - _overlap_constraint(len_s, len_s, t, sim) + 1, xp)
+    return xp, xi
+
+
+@njit(cache=True)
+def _suffix_filter(tokens, x_start, x_end, y_start, y_end, hmax, max_depth, frames):
+    """
+    `ppjoin_.suffix_filter` on two ranges of the packed tokens.
+    The recursion is unrolled on `frames` (max_depth + 1 rows), numba can not load recursive functions from its cache.
+    Frame columns: x_start, x_end, y_start, y_end, hmax, stage, p, xr_start, mid, diff, right_diff, hl.
+    """
+    top = 0
+    frames[0, 0], frames[0, 1], frames[0, 2], frames[0, 3], frames[0, 4] = x_start, x_end, y_start, y_end, hmax
+    returning = False
+    h = 0
+    while True:
+        if not returning:
+            xs, xe, ys, ye, hm = frames[top, 0], frames[top, 1], frames[top, 2], frames[top, 3], frames[top, 4]
+            x_len, y_len = xe - xs, ye - ys
+            if x_len == 0 or y_len == 0:
+                h = x_len + y_len
+                returning = True
+                continue
+            if top + 1 > max_depth:
+                h = abs(x_len - y_len)
+                returning = True
+                continue
+
+            mid = ys + y_len // 2
+            w = tokens[mid]
+            p = xs + np.searchsorted(tokens[xs:xe], w)
+            if p < xe and tokens[p] == w:
+                xr_start, diff = p + 1, 0
+            else:
+                xr_start, diff = p, 1
+            left_diff, right_diff = abs((p - xs) - (mid - ys)), abs((xe - xr_start) - (ye - mid - 1))
+            h = left_diff + right_diff + diff
+            if h > hm:
+                returning = True
+                continue
+
+            frames[top, 5], frames[top, 6], frames[top, 7], frames[top, 8] = 1, p, xr_start, mid
+            frames[top, 9], frames[top, 10] = diff, right_diff
+            # left parts
+            frames[top + 1, 0], frames[top + 1, 1], frames[top + 1, 2], frames[top + 1, 3] = xs, p, ys, mid
+            frames[top + 1, 4] = hm - right_diff - diff
+            top += 1
+            continue
+
+        # h is the result of frame top, hand it to its parent
+        if top == 0:
+            return h
+        top -= 1
+        hm, diff, right_diff = frames[top, 4], frames[top, 9], frames[top, 10]
+        if frames[top, 5] == 1:
+            hl = h
+            h = hl + right_diff + diff
+            if h > hm:
+                continue
+            frames[top, 5], frames[top, 11] = 2, hl
+            # right parts
+            frames[top + 1, 0], frames[top + 1, 1] = frames[top, 7], frames[top, 1]
+            frames[top + 1, 2], frames[top + 1, 3] = frames[top, 8] + 1, frames[top, 3]
+            frames[top + 1, 4] = hm - hl - diff
+            top += 1
+            returning = False
+        else:
+            h = frames[top, 11] + h + diff
+
+
+@njit(cache=True, nogil=True)
+def build_index(tokens, offsets, lo, hi, t, sim, n_tokens):
+    """
+    CSR inverted index of the indexing prefixes of records [lo, hi): token -> records, positions.
+    """
+    counts = np.zeros(n_tokens + 1, np.int64)
+    for r in range(lo, hi):
+        xp, xi = _prefix_lengths(offsets[r + 1] - offsets[r], t, sim)
+        for i in range(xi):
+            counts[tokens[offsets[r] + i] + 1] += 1
+    ii_offsets = np.cumsum(counts)
+    fill = ii_offsets[:-1].copy()
+    ii_records = np.empty(ii_offsets[-1], np.int32)
+    ii_positions = np.empty(ii_offsets[-1], np.int32)
+    for r in range(lo, hi):
+        xp, xi = _prefix_lengths(offsets[r + 1] - offsets[r], t, sim)
+        for i in range(xi):
+            token = tokens[offsets[r] + i]
+            ii_records[fill[token]] = r
+            ii_positions[fill[token]] = i
+            fill[token] += 1
+    return ii_offsets, ii_records, ii_positions
+
+
+def workspace(n):
+    """
+    Per-record candidate state for `candidates`, reused across calls: state (0: not seen, 1: candidate, 2: pruned),
+    overlap, last matched positions in x and y, and the records in order of first encounter.
+    """
+    return np.zeros(n, np.int8), np.zeros(n, np.int32), np.zeros(n, np.int32), np.zeros(n, np.int32), \
+        np.empty(n, np.int32)
+
+
+@njit(cache=True, nogil=True)
+def candidates(tokens, offsets, sources, t, sim, plus, max_depth, first, last, bound,
+               ii_offsets, ii_records, ii_positions, counters, state, overlaps, last_i, last_j, touched):
+    """
+    Candidates (x, y, overlap, i, j) of records x in [first, last) with indexed records y < min(x, bound),
+    left after the length, positional and (with `plus`) suffix filters on the prefixes.
+    """
+    frames = np.empty((max_depth + 1, 12), np.int64)
+    size = 0
+    cap = 1024
+    out = np.empty((cap, 5), np.int32)
+    has_sources = len(sources) > 0
+
+    for x in range(first, last):
+        xs = offsets[x]
+        xr_len = offsets[x + 1] - xs
+        if xr_len == 0:
+            continue
+        xp, xi = _prefix_lengths(xr_len, t, sim)
+        min_len = _min_length(xr_len, t, sim)
+        y_bound = min(x, bound)
+        n_touched = 0
+
+        for i in range(xp):
+            token = tokens[xs + i]
+            if token + 1 >= len(ii_offsets):
+                continue
+            for k in range(ii_offsets[token], ii_offsets[token + 1]):
+                y = ii_records[k]
+                if y >= y_bound:
+                    break
+                if has_sources and sources[y] == sources[x]:
+                    continue
+                counters[0] += 1
+                j = ii_positions[k]
+                ys = offsets[y]
+                yr_len = offsets[y + 1] - ys
+                if yr_len < min_len:
+                    counters[1] += 1
+                    continue
+                s = state[y]
+                if s == 2:
+                    continue
+                overlap = overlaps[y] if s == 1 else 0
+                alpha = _overlap_constraint(xr_len, yr_len, t, sim)
+                if overlap + 1 + min(xr_len - i - 1, yr_len - j - 1) < alpha:
+                    if s == 0:
+                        touched[n_touched] = y
+                        n_touched += 1
+                    state[y] = 2
+                    counters[2] += 1
+                elif s == 1:
+                    overlaps[y] += 1
+                    last_i[y] = i
+                    last_j[y] = j
+                else:
+                    touched[n_touched] = y
+                    n_touched += 1
+                    hmax = xr_len + yr_len - i - j - 2 * alpha
+                    if plus and _suffix_filter(tokens, xs + i + 1, xs + xr_len, ys + j + 1, ys + yr_len,
+                                               hmax, max_depth, frames) > hmax:
+                        state[y] = 2
+                        counters[3] += 1
+                    else:
+                        state[y] = 1
+                        overlaps[y] = 1
+                        last_i[y] = i
+                        last_j[y] = j
+
+        for k in range(n_touched):
+            y = touched[k]
+            if state[y] == 1:
+                if size == cap:
+                    cap *= 2
+                    grown = np.empty((cap, 5), np.int32)
+                    grown[:size] = out[:size]
+                    out = grown
+                out[size, 0] = x
+                out[size, 1] = y
+                out[size, 2] = overlaps[y]
+                out[size, 3] = last_i[y]
+                out[size, 4] = last_j[y]
+                size += 1
+            state[y] = 0
+    return out[:size]
+
+
+@njit(cache=True, nogil=True)
+def verify(tokens, offsets, t, sim, candidates, counters):
+    """
+    Mask of the candidates whose overlap, counted on from the last matched positions, reaches the constraint.
+    The overlap column of matched candidates is updated to their full overlap.
+    """
+    matched = np.zeros(len(candidates), np.bool_)
+    for c in range(len(candidates)):
+        x, y, overlap, i, j = candidates[c, 0], candidates[c, 1], candidates[c, 2], candidates[c, 3], candidates[c, 4]
+        xs, ys = offsets[x], offsets[y]
+        xr_len, yr_len = offsets[x + 1] - xs, offsets[y + 1] - ys
+        alpha = _overlap_constraint(xr_len, yr_len, t, sim)
+        if overlap + min(xr_len - i - 1, yr_len - j - 1) < alpha:
+            counters[3] += 1
+            continue
+
+        counters[4] += 1
+        required = alpha - overlap
+        found = 0
+        i += 1
+        j += 1
+        while i < xr_len and j < yr_len:
+            a, b = tokens[xs + i], tokens[ys + j]
+            if a == b:
+                found += 1
+                i += 1
+                j += 1
+            elif a < b:
+                i += 1
+                if found + xr_len - i < required:
+                    break
+            else:
+                j += 1
+                if found + yr_len - j < required:
+                    break
+        if overlap + found >= alpha:
+            counters[5] += 1
+            matched[c] = True
+            candidates[c, 2] = overlap + found
+    return matched
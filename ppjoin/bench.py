@@ -0,0 +1,264 @@
+"""
+Benchmarks for PPJoin and P4Join
+
+Times the stages of both joins (encoding, preprocess, compare and result mapping)
+on synthetic Zipf-distributed token sets or on CSV files and reports the peak RSS of every run.
+Results are printed as JSON so runs can be compared across versions.
+
+Usage:
+python -m ppjoin.bench --records 20000 -t 0.6 -t 0.8
+python -m ppjoin.bench --csv Abt.csv --csv Buy.csv --column name --output result.json
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import List
+
+from ppjoin import __version__, ppjoin, p4join
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def zipf_datasets(n_datasets: int = 1, n_records: int = 10000, min_len: int = 5, max_len: int = 30,
+                  vocab_size: int = 100000, s: float = 1.0, dup_rate: float = 0.2, seed: int = 0) -> List[List[set]]:
+    """
+    Generate datasets of token sets drawn from a Zipf distribution over `vocab_size` tokens.
+    A `dup_rate` fraction of records are near-duplicates of earlier records (some tokens replaced),
+    so that joins have results at high thresholds as well.
+    """
+    rng = random.Random(seed)
+    vocab = ['t{}'.format(i) for i in range(vocab_size)]
+    cum_weights = list(itertools.accumulate(1.0 / (i ** s) for i in range(1, vocab_size + 1)))
+
+    generated = []
+    datasets = []
+    for _ in range(n_datasets):
+        ds = []
+        for _ in range(n_records):
+            if generated and rng.random() < dup_rate:
+                record = set(rng.choice(generated))
+                for token in rng.sample(sorted(record), rng.randint(0, max(1, len(record) // 4))):
+                    record.discard(token)
+                    record.add(rng.choices(vocab, cum_weights=cum_weights)[0])
+            else:
+                length = rng.randint(min_len, max_len)
+                record = set(rng.choices(vocab, cum_weights=cum_weights, k=length))
+            generated.append(record)
+            ds.append(record)
+        datasets.append(ds)
+    return datasets
+
+
+def csv_datasets(paths: List[str], column: str, tokenizer: str = 'whitespace', q: int = 3,
+                 encoding: str = 'utf-8') -> List[List[set]]:
+    """
+    Read one dataset per CSV file and tokenize `column` of each row.
+    """
+    datasets = []
+    for path in paths:
+        with open(path, encoding=encoding) as f:
+            if tokenizer == 'qgram':
+                datasets.append([set(ppjoin.qgram_tokenizer(q, row[column].lower(), padded=True))
+                                 for row in csv.DictReader(f)])
+            else:
+                datasets.append([set(ppjoin.whitespace_tokenizer(row[column].lower()))
+                                 for row in csv.DictReader(f)])
+    return datasets
+
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    yield
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def warm_up(engine=None):
+    """
+    Load or compile the kernels of the PPJoin `engine` on a tiny join, so the first timed threshold does not pay for it.
+    """
+    records = ppjoin.unpack_records(*ppjoin.pack_records([[0, 1], [0, 1, 2], [0, 2]]))
+    ppjoin.compare(records, 0.5, sources=array('i', [0, 1, 1]), engine=engine)
+    ppjoin.compare(records, 0.5, engine=engine)
+
+
+def bench_ppjoin(datasets, t, stats=None, engine=None):
+    timings = {}
+    with timed(timings, 'preprocess'):
+        dataset, dataset_id_offset = ppjoin.concat_datasets(datasets)
+        records_sorted, original_order, order_map = ppjoin.preprocess(dataset)
+        sources = ppjoin.record_sources(original_order, dataset_id_offset)
+    with timed(timings, 'compare'):
+        result = ppjoin.compare(records_sorted, t, stats=stats, sources=sources, engine=engine)
+    with timed(timings, 'map'):
+        pairs = set()
+        for r1id, r2id in result:
+            pair = ppjoin.map_pair(r1id, r2id, original_order, dataset_id_offset)
+            if pair is not None:
+                pairs.add(pair)
+    return timings, len(pairs)
+
+
+def bench_p4join(datasets, t, vec_len, engine=None, stats=None):
+    timings = {}
+    with timed(timings, 'preprocess'):
+        dataset, dataset_id_offset = ppjoin.concat_datasets(datasets)
+        records_sorted, original_order, order_map, meta = p4join.preprocess(dataset, vec_len, t)
+        sources = ppjoin.record_sources(original_order, dataset_id_offset)
+    with timed(timings, 'compare'):
+        result = p4join.compare(records_sorted, vec_len, t, order_map, engine, meta, stats, sources)
+    with timed(timings, 'map'):
+        pairs = set()
+        for r1id, r2id in result:
+            pair = ppjoin.map_pair(r1id, r2id, original_order, dataset_id_offset)
+            if pair is not None:
+                pairs.add(pair)
+    return timings, len(pairs)
+
+
+def _bench_run(algorithm, datasets, t, vec_len, engine, with_stats, ppjoin_engine):
+    """
+    One timed run, made in a fresh process by `run`: returns its timings, pairs, stats and peak RSS.
+    """
+    stats = ppjoin.JoinStats() if with_stats else None
+    if algorithm == 'ppjoin':
+        warm_up(ppjoin_engine)
+        timings, pairs = bench_ppjoin(datasets, t, stats, ppjoin_engine)
+    else:
+        timings, pairs = bench_p4join(datasets, t, vec_len, engine, stats)
+    return timings, pairs, stats, peak_rss_kb()
+
+
+def run(datasets, thresholds, algorithms=('ppjoin', 'p4join'), vec_len=1000, k=2, hmac_key='key',
+        engine=None, repeat=1, with_stats=False, ppjoin_engine=None):
+    """
+    Run the benchmarks and return a JSON serializable report.
+    Every (algorithm, threshold) is run `repeat` times and the fastest run is reported.
+    Each run is made in a fresh process, so its `peak_rss_kb` only covers the interpreter, its input and the join.
+    With `with_stats`, filter counters (see `ppjoin.JoinStats`) of the reported run are added.
+    `engine` is the P4Join engine and `ppjoin_engine` the PPJoin one (by default numba if installed),
+    which is warmed up before timing.
+    """
+    if ppjoin_engine is None:
+        ppjoin_engine = 'python' if ppjoin._numba is None else 'numba'
+    report = {
+        'ppjoin_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'datasets': [len(d) for d in datasets],
+        'tokens': sum(len(r) for d in datasets for r in d),
+        'ppjoin_engine': ppjoin_engine,
+        'results': [],
+    }
+
+    encoded = None
+    context = multiprocessing.get_context('spawn')
+    for algorithm in algorithms:
+        if algorithm not in ('ppjoin', 'p4join'):
+            raise ValueError('Unknown algorithm: {}'.format(algorithm))
+        extra = {}
+        if algorithm == 'p4join' and encoded is None:
+            start = time.perf_counter()
+            encoded = [p4join.encode_dataset(d, hmac_key, vec_len, k) for d in datasets]
+            extra['encode'] = time.perf_counter() - start
+
+        for t in thresholds:
+            best = None
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    run_result = executor.submit(_bench_run, algorithm, encoded if algorithm == 'p4join' else datasets,
+                                                 t, vec_len, engine, with_stats, ppjoin_engine).result()
+                if best is None or sum(run_result[0].values()) < sum(best[0].values()):
+                    best = run_result
+
+            timings, pairs, stats, peak = best
+            timings.update(extra)
+            result = {
+                'algorithm': algorithm,
+                'threshold': t,
+                'pairs': pairs,
+                'timings': timings,
+                'total': sum(timings.values()),
+                'peak_rss_kb': peak,
+            }
+            if stats is not None:
+                result['filters'] = stats.as_dict()
+            report['results'].append(result)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ppjoin.bench', description='Benchmark PPJoin and P4Join.')
+    parser.add_argument('-a', '--algorithm', action='append', choices=['ppjoin', 'p4join'],
+                        help='Algorithms to run (default: both)')
+    parser.add_argument('-t', '--threshold', action='append', type=float, help='Thresholds (default: 0.5 0.7 0.9)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per threshold, the fastest is reported')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--stats', action='store_true', help='Add filter counters and stage timings of compare')
+
+    synthetic = parser.add_argument_group('synthetic workload')
+    synthetic.add_argument('--datasets', type=int, default=1, help='Number of datasets')
+    synthetic.add_argument('--records', type=int, default=10000, help='Records per dataset')
+    synthetic.add_argument('--min-len', type=int, default=5, help='Minimum tokens per record')
+    synthetic.add_argument('--max-len', type=int, default=30, help='Maximum tokens per record')
+    synthetic.add_argument('--vocab', type=int, default=100000, help='Vocabulary size')
+    synthetic.add_argument('--zipf', type=float, default=1.0, help='Zipf exponent')
+    synthetic.add_argument('--dup-rate', type=float, default=0.2, help='Fraction of near-duplicate records')
+    synthetic.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    real = parser.add_argument_group('CSV workload')
+    real.add_argument('--csv', action='append', help='CSV file, one dataset per file (replaces the synthetic one)')
+    real.add_argument('--column', default='name', help='Column to tokenize')
+    real.add_argument('--tokenizer', choices=['whitespace', 'qgram'], default='whitespace')
+    real.add_argument('--encoding', default='utf-8', help='Encoding of the CSV files')
+
+    parser.add_argument('--ppjoin-engine', choices=['python', 'numba'],
+                        help='PPJoin engine (default: numba if installed)')
+
+    p4 = parser.add_argument_group('P4Join')
+    p4.add_argument('--vec-len', type=int, default=1000, help='Bloom filter length')
+    p4.add_argument('--k', type=int, default=2, help='Hash rounds per token')
+    p4.add_argument('--engine', choices=['python', 'numpy'], help='P4Join engine (default: numpy if installed)')
+
+    args = parser.parse_args(argv)
+
+    if args.csv:
+        datasets = csv_datasets(args.csv, args.column, args.tokenizer, encoding=args.encoding)
+    else:
+        datasets = zipf_datasets(args.datasets, args.records, args.min_len, args.max_len,
+                                 args.vocab, args.zipf, args.dup_rate, args.seed)
+
+    report = run(datasets, args.threshold or [0.5, 0.7, 0.9], args.algorithm or ['ppjoin', 'p4join'],
+                 args.vec_len, args.k, engine=args.engine, repeat=args.repeat, with_stats=args.stats,
+                 ppjoin_engine=args.ppjoin_engine)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
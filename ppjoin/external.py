@@ -0,0 +1,199 @@
+"""
+Out-of-core PPJoin
+
+Joins datasets that do not fit in memory.
+Records are read once from their iterators and spilled to length-sorted runs on disk,
+the runs are merged into length-sorted chunks that fit the memory budget,
+and every chunk is joined with itself and with the earlier chunks the length filter can not rule out.
+Only the token vocabulary and two chunks with their inverted index are in memory at a time.
+"""
+import heapq
+import os
+import struct
+import tempfile
+import time
+from array import array
+from typing import Iterable, Iterator, Set, Tuple
+
+from ppjoin.ppjoin_ import JoinStats, check_similarity, iter_compare, merge_overlap, min_length, similarity, \
+    unpack_records
+
+RECORD = struct.Struct('<iqi')  # number of tokens, record index in its dataset, dataset index
+RECORD_BYTES = 200  # rough in-memory size of a record besides its tokens
+TOKEN_BYTES = 12  # a token in the packed buffer plus its share of the inverted index
+
+
+def _write_record(f, tokens, rid, source):
+    f.write(RECORD.pack(len(tokens), rid, source))
+    tokens.tofile(f)
+
+
+def _read_records(path):
+    """
+    Yield (tokens, record index, dataset index) from a spill file.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            n, rid, source = RECORD.unpack(header)
+            tokens = array('i')
+            tokens.fromfile(f, n)
+            yield tokens, rid, source
+
+
+def _record_key(record):
+    tokens, rid, source = record
+    return len(tokens), source, rid
+
+
+def _spill_runs(datasets, budget, tmp):
+    """
+    Read all records once, encode their distinct tokens with provisional ids
+    and write them to runs sorted by length, each at most `budget` bytes in memory.
+    Returns the tokens by provisional id, their document frequencies, the run files and the number of datasets.
+    """
+    vocab = {}  # token -> provisional id
+    df = array('q')
+    runs = []
+    buffer = []
+    size = 0
+
+    def flush():
+        path = os.path.join(tmp, 'run{}'.format(len(runs)))
+        buffer.sort(key=_record_key)
+        with open(path, 'wb') as f:
+            for tokens, rid, source in buffer:
+                _write_record(f, tokens, rid, source)
+        runs.append(path)
+        buffer.clear()
+
+    n_datasets = 0
+    for source, dataset in enumerate(datasets):
+        n_datasets += 1
+        for rid, record in enumerate(dataset):
+            ids = set()
+            for token in record:
+                i = vocab.get(token)
+                if i is None:
+                    i = vocab[token] = len(df)
+                    df.append(0)
+                ids.add(i)
+            for i in ids:
+                df[i] += 1
+            buffer.append((array('i', ids), rid, source))
+            size += RECORD_BYTES + TOKEN_BYTES * len(ids)
+            if size >= budget:
+                flush()
+                size = 0
+    if buffer:
+        flush()
+    return list(vocab), df, runs, n_datasets
+
+
+def _merge_runs(runs, rank_of, budget, tmp):
+    """
+    Merge the runs into chunks of length-sorted records whose tokens are replaced by their sorted ranks.
+    """
+    chunks = []
+    f = None
+    size = 0
+    min_len = max_len = 0
+    for tokens, rid, source in heapq.merge(*(_read_records(path) for path in runs), key=_record_key):
+        if f is None:
+            path = os.path.join(tmp, 'chunk{}'.format(len(chunks)))
+            f = open(path, 'wb')
+            min_len = len(tokens)
+        _write_record(f, array('i', sorted(rank_of[x] for x in tokens)), rid, source)
+        max_len = len(tokens)
+        size += RECORD_BYTES + TOKEN_BYTES * len(tokens)
+        if size >= budget:
+            f.close()
+            chunks.append((path, min_len, max_len))
+            f = None
+            size = 0
+    if f is not None:
+        f.close()
+        chunks.append((path, min_len, max_len))
+    for path in runs:
+        os.remove(path)
+    return chunks
+
+
+def _load_chunk(path):
+    tokens = array('i')
+    offsets = array('q', [0])
+    rids = array('q')
+    sources = array('i')
+    for r, rid, source in _read_records(path):
+        tokens.extend(r)
+        offsets.append(len(tokens))
+        rids.append(rid)
+        sources.append(source)
+    return unpack_records(tokens, offsets), rids, sources
+
+
+def iter_join(datasets: Iterable[Iterable[Iterable[str]]], t: float = 0, memory: int = 2 ** 28,
+              tmp_dir: str = None, with_score: bool = False, stats: JoinStats = None, plus: bool = False,
+              sim: str = 'jaccard') -> Iterator[Tuple]:
+    """
+    Same as `ppjoin.iter_join`, but datasets are only iterated once and records are kept on disk.
+
+    `memory` is the approximate budget in bytes for the records and the inverted index,
+    spill files are written to a temporary directory under `tmp_dir` and removed at the end.
+    The token vocabulary is kept in memory.
+    """
+    check_similarity(sim)
+    budget = max(memory // 2, 1)  # two chunks are joined at a time
+
+    with tempfile.TemporaryDirectory(prefix='ppjoin-', dir=tmp_dir) as tmp:
+        started = time.perf_counter()
+        tokens, df, runs, n_datasets = _spill_runs(datasets, budget, tmp)
+        # same ranks as `ppjoin.preprocess`: rarest first
+        order = sorted(range(len(tokens)), key=list(zip(df, tokens)).__getitem__)
+        del tokens, df
+        rank_of = array('i', bytes(4 * len(order)))
+        for rank, x in enumerate(order):
+            rank_of[x] = rank
+        del order
+        chunks = _merge_runs(runs, rank_of, budget, tmp)
+        del rank_of
+        if stats is not None:
+            stats.timings['spill'] += time.perf_counter() - started
+
+        for b, (path, min_len, _) in enumerate(chunks):
+            records_b, rids_b, sources_b = _load_chunk(path)
+            shortest = min_length(min_len, t, sim) if t > 0 else 0
+
+            # earlier chunks first, records of chunk b only probe them, then chunk b on its own
+            for a in range(b + 1):
+                if a < b:
+                    if chunks[a][2] < shortest:  # length filter
+                        continue
+                    records_a, rids_a, sources_a = _load_chunk(chunks[a][0])
+                    records = records_a + records_b
+                    rids, sources = rids_a + rids_b, sources_a + sources_b
+                    result = iter_compare(records, t, len(records_a), stats=stats, plus=plus,
+                                          sources=sources if n_datasets > 1 else None, sim=sim, cross=True)
+                else:
+                    records, rids, sources = records_b, rids_b, sources_b
+                    result = iter_compare(records, t, stats=stats, plus=plus,
+                                          sources=sources if n_datasets > 1 else None, sim=sim)
+
+                for x, y in result:
+                    pair = tuple(sorted(((sources[x], rids[x]), (sources[y], rids[y]))))
+                    if with_score:
+                        xr, yr = records[x], records[y]
+                        yield pair + (similarity(len(xr), len(yr), merge_overlap(xr, yr), sim),)
+                    else:
+                        yield pair
+
+
+def join(datasets: Iterable[Iterable[Iterable[str]]], t: float = 0, memory: int = 2 ** 28,
+         tmp_dir: str = None, stats: JoinStats = None, plus: bool = False,
+         sim: str = 'jaccard') -> Set[Tuple[Tuple]]:
+    """
+    Same as `ppjoin.join` with the memory bound of `iter_join`, only the result has to fit in memory.
+    """
+    return set(iter_join(datasets, t, memory, tmp_dir, stats=stats, plus=plus, sim=sim))
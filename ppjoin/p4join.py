@@ -10,12 +10,22 @@ Datenbanksysteme für Business, Technologie und Web (BTW 2015) (2015).
 Implemented by GreatYYX https://github.com/greatyyx
 """
 import collections
-from itertools import product
-from functools import reduce
-from typing import List, Tuple, Set
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, reduce
+from itertools import islice
+from operator import or_
+from typing import Iterable, Iterator, List, Tuple, Set
 import hashlib
 import hmac
-from ppjoin.ppjoin_ import ceil
+import random
+import time
+from ppjoin.ppjoin_ import ceil, concat_datasets, map_pair, record_sources, JoinStats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def list_to_vec(l):
@@ -47,13 +57,21 @@ def all_sb_idx(b, vec_len):
     Get set-bit indices
     """
     l = []
-    for idx in reversed(range(vec_len)):
-        if b & 1:
-            l.append(idx)
-        b >>= 1
+    b &= (1 << vec_len) - 1
+    while b:
+        lowest = b & -b
+        l.append(vec_len - lowest.bit_length())
+        b ^= lowest
     return list(reversed(l))
 
 
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(b):
+        return bin(b).count('1')
+
+
 def set_bit(b, vec_len, idx):
     return b | 1 << (vec_len - 1 - idx)
 
@@ -62,18 +80,84 @@ def base_hash(key, msg, method):
     return int(hmac.new(key=key, msg=msg, digestmod=method).hexdigest(), 16)
 
 
-def encode_record(record: List[List[str]], hmac_key: str, vec_len: int, k: int = 2) -> List[int]:
+def token_encoder(hmac_key: str, vec_len: int, k: int = 2, cache_size: int = 2 ** 20):
+    """
+    Return a function that maps a token to the bit vector with its k bits set.
+    The HMACs are keyed once and copied for every token, both digests are computed once per token
+    and shared by all k rounds, and the last `cache_size` distinct tokens are memoized.
+    """
     hmac_key = str_to_byte(hmac_key)
-    vec = 0
-    for t in record:
+    sha1 = hmac.new(key=hmac_key, digestmod=hashlib.sha1)
+    md5 = hmac.new(key=hmac_key, digestmod=hashlib.md5)
+
+    @lru_cache(maxsize=cache_size)
+    def encode_token(t):
         t = str_to_byte(t)
+        h1, h2 = sha1.copy(), md5.copy()
+        h1.update(t)
+        h2.update(t)
+        h1, h2 = int.from_bytes(h1.digest(), 'big'), int.from_bytes(h2.digest(), 'big')
+        vec = 0
         for i in range(1, k+1):
-            set_bit_idx = (
-                base_hash(key=hmac_key, msg=t, method=hashlib.sha1) +
-                base_hash(key=hmac_key, msg=t, method=hashlib.md5) * i
-            ) % vec_len
-            vec = set_bit(vec, vec_len, set_bit_idx)
-    return vec
+            vec = set_bit(vec, vec_len, (h1 + h2 * i) % vec_len)
+        return vec
+
+    return encode_token
+
+
+def encode_record(record: List[List[str]], hmac_key: str, vec_len: int, k: int = 2) -> List[int]:
+    return reduce(or_, map(token_encoder(hmac_key, vec_len, k, cache_size=0), record), 0)
+
+
+_worker_encoder = None
+
+
+def _init_encoder(hmac_key, vec_len, k, cache_size):
+    global _worker_encoder
+    _worker_encoder = token_encoder(hmac_key, vec_len, k, cache_size)
+
+
+def _encode_chunk(records):
+    return [reduce(or_, map(_worker_encoder, r), 0) for r in records]
+
+
+def _chunks(records, chunk_size):
+    it = iter(records)
+    while True:
+        chunk = [list(r) for r in islice(it, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def encode_dataset(records: Iterable[Iterable[str]], hmac_key: str, vec_len: int, k: int = 2,
+                   cache_size: int = 2 ** 20, workers: int = 1, chunk_size: int = 10000, packed: bool = False):
+    """
+    Encode all records of a dataset, the result is identical to calling `encode_record` on each of them.
+    With `workers` > 1, chunks of `chunk_size` records are encoded in a process pool,
+    only a few chunks are in flight at a time so the input can be a stream of any size.
+    Returns a list of ints, or a (n, words) uint64 matrix (see `to_matrix`) if `packed`.
+    """
+    if workers > 1:
+        encoded = []
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_encoder,
+                                 initargs=(hmac_key, vec_len, k, cache_size)) as executor:
+            for chunk in _chunks(records, chunk_size):
+                pending.append(executor.submit(_encode_chunk, chunk))
+                if len(pending) > 2 * workers:
+                    encoded.extend(pending.popleft().result())
+            while pending:
+                encoded.extend(pending.popleft().result())
+    else:
+        encode_token = token_encoder(hmac_key, vec_len, k, cache_size)
+        encoded = [reduce(or_, map(encode_token, r), 0) for r in records]
+
+    if packed:
+        if np is None:
+            raise ImportError('Packed output requires numpy, install it with `pip install numpy`')
+        return to_matrix(encoded, vec_len)
+    return encoded
 
 
 def prefix(vec, vec_len, t):
@@ -83,61 +167,352 @@ def prefix(vec, vec_len, t):
     prefix_length = min(prefix_length, len(sb_idx))
     prefix_sb_idx = sb_idx[:prefix_length]
     prefix_vec = map(lambda x: set_bit(0, vec_len, x), prefix_sb_idx[:])
-    return reduce(lambda x, y: x | y, prefix_vec)
+    return reduce(lambda x, y: x | y, prefix_vec, 0)
 
 
-def compare(records, vec_len, t, order_map):
-    cp = set()
-    lmap = collections.defaultdict(set)
+RecordMeta = collections.namedtuple('RecordMeta', ['card', 'prefix', 'prefix_len', 'prefix_last'])
+
+
+def record_meta(records, vec_len, t):
+    """
+    Per-record metadata used by the filters:
+    cardinality, prefix vector, prefix length and index of the last prefix bit (-1 for empty records).
+    """
+    meta = RecordMeta(array('i'), [], array('i'), array('i'))
+    for vec in records:
+        sb_idx = all_sb_idx(vec, vec_len)
+        prefix_length = len(sb_idx) - ceil(t * len(sb_idx)) + 1
+        prefix_length = min(prefix_length, len(sb_idx))
+        last = sb_idx[prefix_length - 1] if prefix_length else -1
+        # keep set bits up to the last prefix bit
+        shift = vec_len - 1 - last
+        meta.card.append(len(sb_idx))
+        meta.prefix.append(vec >> shift << shift if prefix_length else 0)
+        meta.prefix_len.append(prefix_length)
+        meta.prefix_last.append(last)
+    return meta
 
-    if t == 0:
-        return set(filter(lambda x: x[0] != x[1], product(range(len(records)), range(len(records)))))
 
-    for xr_idx, xr in enumerate(records):
-        xl = len(all_sb_idx(xr, vec_len))
-        for el in list(lmap.keys()):
+def compare(records, vec_len, t, order_map, engine=None, meta=None, stats=None, sources=None):
+    return set(iter_compare(records, vec_len, t, order_map, engine, meta, stats, sources))
 
-            if el < xl * t:  # length filter
-                del lmap[el]
+
+def iter_compare(records, vec_len, t, order_map, engine=None, meta=None, stats=None, sources=None):
+    """
+    Generator version of `compare`, pairs (x, y) with y < x are yielded as soon as they are verified.
+    `engine` is `python` or `numpy` (see `iter_compare_numpy`), by default numpy is used if it is installed.
+    `meta` is the metadata from `preprocess`, it is computed if not given.
+    Filter counters and timings are collected into `stats` (a `JoinStats`) if given.
+    If `sources` (the source dataset of every record) is given, only pairs from different sources are found.
+    """
+    if engine is None:
+        engine = 'python' if np is None else 'numpy'
+
+    if t == 0:
+        yield from ((x, y) for x in range(len(records)) for y in range(x) if not sources or sources[x] != sources[y])
+        return
+    if meta is None:
+        meta = record_meta(records, vec_len, t)
+    if engine == 'numpy':
+        yield from iter_compare_numpy(records, vec_len, t, meta, stats, sources)
+        return
+    if engine != 'python':
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    positional_filtered = verified = matches = 0
+    timer = time.perf_counter if stats is not None else None
+    if timer:
+        mark = timer()
+    card, prefixes, prefix_len, prefix_last = meta
+    for xr_idx, candidates in iter_candidates(records, vec_len, t, meta, stats, sources):
+        if timer:
+            probed = timer()
+            stats.timings['candidates'] += probed - mark
+        xr, xl, xp = records[xr_idx], card[xr_idx], prefixes[xr_idx]
+        for yr_idx in candidates:
+            yl, yp = card[yr_idx], prefixes[yr_idx]
+            if positional_filter(xp, yp, xl, yl, t, vec_len,
+                                 prefix_len[xr_idx], prefix_len[yr_idx], prefix_last[xr_idx], prefix_last[yr_idx]):
+                positional_filtered += 1
                 continue
 
-            for (yr_idx, yr) in lmap[el]:
-                xp = prefix(xr, vec_len, t)
-                yp = prefix(yr, vec_len, t)
-                if xp & yp == 0:  # prefix filter
+            verified += 1
+            score = jaccard(xr, records[yr_idx], vec_len, xl, yl)
+            if score >= t:
+                matches += 1
+                yield xr_idx, yr_idx
+        if timer:
+            mark = timer()
+            stats.timings['verify'] += mark - probed
+
+    if stats is not None:
+        stats.positional_filtered += positional_filtered
+        stats.verified += verified
+        stats.matches += matches
+
+
+def iter_candidates(records, vec_len, t, meta, stats=None, sources=None):
+    """
+    Candidate generation with an inverted index on prefix bits.
+    For every record, yield its index and the set of earlier records
+    that share at least one prefix bit with it and pass the length filter.
+    With `sources`, every source has its own index and only the indexes of the other sources are probed.
+    """
+    # inverted indexes: prefix bit -> records
+    indexes = [collections.defaultdict(collections.deque) for _ in range(max(sources) + 1 if sources else 1)]
+    card, prefixes = meta.card, meta.prefix
+    probes = length_filtered = 0
+    for xr_idx in range(len(records)):
+        min_len = card[xr_idx] * t
+        prefix_sb_idx = all_sb_idx(prefixes[xr_idx], vec_len)
+        own = indexes[sources[xr_idx]] if sources else indexes[0]
+        candidates = set()
+        for ii in indexes:
+            if sources and ii is own:
+                continue
+            for idx in prefix_sb_idx:
+                postings = ii.get(idx)
+                if not postings:
                     continue
+                probes += len(postings)
+                # records are sorted by cardinality, so records failing the length filter
+                # are at the front and will fail for all later records as well
+                while postings and card[postings[0]] < min_len:
+                    postings.popleft()
+                    length_filtered += 1
+                candidates.update(postings)
+        for idx in prefix_sb_idx:
+            own[idx].append(xr_idx)
+        yield xr_idx, candidates
+
+    if stats is not None:
+        stats.probes += probes
+        stats.length_filtered += length_filtered
+
+
+def iter_compare_numpy(records, vec_len, t, meta, stats=None, sources=None):
+    """
+    Vectorized `iter_compare` on a (n, words) uint64 bit matrix.
+    The candidates of every probe from `iter_candidates` are verified at once with one popcount.
+    """
+    if np is None:
+        raise ImportError('The numpy engine requires numpy, install it with `pip install numpy`')
+
+    matrix = to_matrix(records, vec_len)
+    cards = np.asarray(meta.card, dtype=np.int64)
+
+    timer = time.perf_counter if stats is not None else None
+    if timer:
+        mark = timer()
+    for xr_idx, candidates in iter_candidates(records, vec_len, t, meta, stats, sources):
+        if timer:
+            probed = timer()
+            stats.timings['candidates'] += probed - mark
+        if candidates:
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            overlap = popcount_rows(matrix[candidates] & matrix[xr_idx])
+            score = overlap / (cards[candidates] + cards[xr_idx] - overlap)
+            matches = candidates[score >= t].tolist()
+            if stats is not None:
+                stats.verified += len(candidates)
+                stats.matches += len(matches)
+            for yr_idx in matches:
+                yield xr_idx, yr_idx
+        if timer:
+            mark = timer()
+            stats.timings['verify'] += mark - probed
+
+
+def to_matrix(records, vec_len):
+    """
+    Store bit vectors as rows of a uint64 matrix (bit order within a row does not matter for set operations).
+    """
+    words = max(1, -(-vec_len // 64))
+    buf = b''.join(r.to_bytes(words * 8, 'little') for r in records)
+    return np.frombuffer(buf, dtype='<u8').reshape(len(records), words)
+
+
+def popcount_rows(matrix):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(matrix).sum(axis=1, dtype=np.int64)
+    return np.unpackbits(matrix.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+
+
+def minhash_permutations(vec_len, num_perm, seed=0):
+    """
+    `num_perm` random permutations of the bit positions, as the rank of every position.
+    """
+    rng = random.Random(seed)
+    perms = []
+    for _ in range(num_perm):
+        perm = list(range(vec_len))
+        rng.shuffle(perm)
+        perms.append(perm)
+    return perms
+
 
-                yl = len(all_sb_idx(yr, vec_len))
-                if positional_filter(xp, yp, xl, yl, t, vec_len):
+def minhash_signatures(records, vec_len, num_perm, seed=0, engine=None):
+    """
+    MinHash signature of every bit vector over its set bits: the lowest rank of a set bit under each permutation.
+    Two vectors agree on a signature entry with probability equal to their Jaccard similarity.
+    Empty vectors get `vec_len` everywhere.
+    `engine` is `python` or `numpy` (by default numpy if it is installed), both return the same lists of ints.
+    """
+    if engine is None:
+        engine = 'python' if np is None else 'numpy'
+    perms = minhash_permutations(vec_len, num_perm, seed)
+
+    if engine == 'numpy':
+        if np is None:
+            raise ImportError('The numpy engine requires numpy, install it with `pip install numpy`')
+        ranks = np.asarray(perms, dtype=np.int32).reshape(num_perm, vec_len)
+        signatures = []
+        for start in range(0, len(records), 4096):
+            matrix = to_matrix(records[start:start + 4096], vec_len)
+            bits = np.unpackbits(matrix.view(np.uint8), axis=1, bitorder='little')[:, :vec_len].astype(bool)
+            sig = np.empty((len(bits), num_perm), dtype=np.int32)
+            # one permutation at a time keeps the temporaries at rows x vec_len, unset bits rank past every set bit
+            for p in range(num_perm):
+                sig[:, p] = np.where(bits, ranks[p], vec_len).min(axis=1)
+            signatures.extend(sig.tolist())
+        return signatures
+    if engine != 'python':
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    signatures = []
+    for vec in records:
+        bits = []
+        while vec:
+            lowest = vec & -vec
+            bits.append(lowest.bit_length() - 1)
+            vec ^= lowest
+        if bits:
+            signatures.append([min(map(perm.__getitem__, bits)) for perm in perms])
+        else:
+            signatures.append([vec_len] * num_perm)
+    return signatures
+
+
+def lsh_recall(s, bands, rows):
+    """
+    Probability that a pair with Jaccard similarity `s` shares at least one of `bands` bands of `rows` MinHashes,
+    i.e. the expected recall of `lsh_join` for pairs of similarity `s` (higher for more similar pairs).
+    """
+    return 1.0 - (1.0 - s ** rows) ** bands
+
+
+def iter_lsh_candidates(signatures, bands, rows, t, card, stats=None, sources=None):
+    """
+    Like `iter_candidates`, but records are candidates if their signatures agree on all rows of at least one band.
+    """
+    # buckets: (band, band signature) -> records
+    indexes = [collections.defaultdict(collections.deque) for _ in range(max(sources) + 1 if sources else 1)]
+    probes = length_filtered = 0
+    for xr_idx, sig in enumerate(signatures):
+        if not card[xr_idx]:
+            yield xr_idx, set()
+            continue
+        min_len = card[xr_idx] * t
+        keys = [(band, tuple(sig[band * rows:(band + 1) * rows])) for band in range(bands)]
+        own = indexes[sources[xr_idx]] if sources else indexes[0]
+        candidates = set()
+        for ii in indexes:
+            if sources and ii is own:
+                continue
+            for key in keys:
+                postings = ii.get(key)
+                if not postings:
                     continue
+                probes += len(postings)
+                while postings and card[postings[0]] < min_len:
+                    postings.popleft()
+                    length_filtered += 1
+                candidates.update(postings)
+        for key in keys:
+            own[key].append(xr_idx)
+        yield xr_idx, candidates
 
-                score = jaccard(xr, yr, vec_len)
-                if score >= t:
-                    cp.add((xr_idx, yr_idx))
+    if stats is not None:
+        stats.probes += probes
+        stats.length_filtered += length_filtered
 
-        lmap[xl].add((xr_idx, xr))
 
-    return cp
+def iter_compare_lsh(records, vec_len, t, meta, bands=32, rows=4, seed=0, engine=None, stats=None, sources=None):
+    """
+    Approximate `iter_compare`: candidates come from MinHash banding instead of the prefix index,
+    then pass the exact prefix, positional and Jaccard checks, so every pair found is a true match.
+    A pair of similarity s is missed with probability 1 - `lsh_recall(s, bands, rows)`.
+    """
+    if t == 0:
+        yield from ((x, y) for x in range(len(records)) for y in range(x) if not sources or sources[x] != sources[y])
+        return
+
+    timer = time.perf_counter if stats is not None else None
+    if timer:
+        mark = timer()
+    signatures = minhash_signatures(records, vec_len, bands * rows, seed, engine)
+    if timer:
+        stats.timings['minhash'] += timer() - mark
+
+    positional_filtered = verified = matches = 0
+    card, prefixes, prefix_len, prefix_last = meta
+    if timer:
+        mark = timer()
+    for xr_idx, candidates in iter_lsh_candidates(signatures, bands, rows, t, card, stats, sources):
+        if timer:
+            probed = timer()
+            stats.timings['candidates'] += probed - mark
+        xr, xl, xp = records[xr_idx], card[xr_idx], prefixes[xr_idx]
+        for yr_idx in candidates:
+            yl, yp = card[yr_idx], prefixes[yr_idx]
+            # similar pairs share a prefix bit
+            if not xp & yp or positional_filter(xp, yp, xl, yl, t, vec_len, prefix_len[xr_idx], prefix_len[yr_idx],
+                                                prefix_last[xr_idx], prefix_last[yr_idx]):
+                positional_filtered += 1
+                continue
+
+            verified += 1
+            if jaccard(xr, records[yr_idx], vec_len, xl, yl) >= t:
+                matches += 1
+                yield xr_idx, yr_idx
+        if timer:
+            mark = timer()
+            stats.timings['verify'] += mark - probed
+
+    if stats is not None:
+        stats.positional_filtered += positional_filtered
+        stats.verified += verified
+        stats.matches += matches
 
 
-def positional_filter(xp, yp, xl, yl, t, vec_len):
-    overlap = len(all_sb_idx(xp & yp, vec_len))
-    sb_idx1 = all_sb_idx(xp, vec_len)
-    sb_idx2 = all_sb_idx(yp, vec_len)
-    p1, p2 = sb_idx1[-1], sb_idx2[-1]
+def positional_filter(xp, yp, xl, yl, t, vec_len, xpl=None, ypl=None, p1=None, p2=None):
+    """
+    `xpl`, `ypl` (prefix lengths) and `p1`, `p2` (indices of the last prefix bits)
+    are computed from the prefixes if not given.
+    """
+    overlap = popcount(xp & yp)
+    if xpl is None:
+        xpl = popcount(xp)
+    if ypl is None:
+        ypl = popcount(yp)
+    if p1 is None:
+        p1 = vec_len - (xp & -xp).bit_length()
+    if p2 is None:
+        p2 = vec_len - (yp & -yp).bit_length()
     diff1, diff2 = 0, 0
 
+    # count prefix bits behind the other prefix's last bit
     if p1 > p2:
-        diff1 = len([sb for sb in sb_idx1 if sb > p2])
+        diff1 = popcount(xp & ((1 << (vec_len - 1 - p2)) - 1))
     else:
-        diff2 = len([sb for sb in sb_idx2 if sb > p1])
+        diff2 = popcount(yp & ((1 << (vec_len - 1 - p1)) - 1))
 
-    rest = min(xl - len(sb_idx1) + diff1, yl - len(sb_idx2) + diff2)
+    rest = min(xl - xpl + diff1, yl - ypl + diff2)
 
     return overlap + rest < ceil((xl + yl) * t / (t + 1))
 
 
-def preprocess(records, vec_len):
+def preprocess(records, vec_len, t=0):
     # get all set bits index of records
     records_sb_idx = []
     for vec in records:
@@ -150,60 +525,94 @@ def preprocess(records, vec_len):
         for i, (el, count) in enumerate(sorted(collections.Counter(elements).items(), key=lambda x: (x[1], x[0])))
     )  # (element, order)
 
-    # reorder set bit of all records
+    # reorder set bit of all records: move every bit to its frequency order,
+    # so that prefixes are made of the rarest bits
     reordered_records = []
     for vec_sb_idx in records_sb_idx:
         vec = 0
-        for set_bit_idx in sorted(vec_sb_idx, key=lambda x: order_map[x]):
-            vec = set_bit(vec, vec_len, set_bit_idx)
+        for set_bit_idx in vec_sb_idx:
+            vec = set_bit(vec, vec_len, order_map[set_bit_idx])
         reordered_records.append(vec)
 
     # sort reordered records based on cardinality
-    argsort = sorted(range(len(reordered_records)), key=lambda i: len(all_sb_idx(reordered_records[i], vec_len)))
-    reordered_records.sort(key=lambda r: len(all_sb_idx(r, vec_len)))
+    argsort = sorted(range(len(reordered_records)), key=lambda i: popcount(reordered_records[i]))
+    reordered_records.sort(key=popcount)
 
-    return reordered_records, argsort, order_map
+    return reordered_records, argsort, order_map, record_meta(reordered_records, vec_len, t)
 
 
-def jaccard(n1, n2, vec_len):
-    return 1.0 * len(all_sb_idx(n1 & n2, vec_len)) / len(all_sb_idx(n1 | n2, vec_len))
+def jaccard(n1, n2, vec_len, n1_card=None, n2_card=None):
+    overlap = popcount(n1 & n2)
+    if n1_card is None or n2_card is None:
+        return 1.0 * overlap / popcount(n1 | n2)
+    return 1.0 * overlap / (n1_card + n2_card - overlap)
 
 
-def join(datasets: List[List[int]], t: float = 0, vec_len: int = 0) -> Set[Tuple[Tuple]]:
+def join(datasets: List[List[int]], t: float = 0, vec_len: int = 0, engine: str = None,
+         stats: JoinStats = None) -> Set[Tuple[Tuple]]:
     ret = set()
     if not datasets:
         return ret
 
-    dataset = []
-    dataset_id_offset = [0]
-    for d in datasets:
-        dataset += d
-        dataset_id_offset.append(len(d) + dataset_id_offset[-1])
-    if len(dataset_id_offset) > 1:
-        dataset_id_offset = dataset_id_offset[:-1]
-
-    records_sorted, original_order, order_map = preprocess(dataset, vec_len)
-    result = compare(records_sorted, vec_len, t, order_map)
-
-    for r in result:
-        r1id, r2id = r[0], r[1]
-        r1id, r2id = original_order[r1id], original_order[r2id]
-        if r1id == r2id:
-            continue
+    started = time.perf_counter()
+    dataset, dataset_id_offset = concat_datasets(datasets)
+    records_sorted, original_order, order_map, meta = preprocess(dataset, vec_len, t)
+    if stats is not None:
+        stats.timings['preprocess'] += time.perf_counter() - started
+    sources = record_sources(original_order, dataset_id_offset)
+    for r1id, r2id in iter_compare(records_sorted, vec_len, t, order_map, engine, meta, stats, sources):
+        pair = map_pair(r1id, r2id, original_order, dataset_id_offset)
+        if pair is not None:
+            ret.add(pair)
+
+    return ret
 
-        # r1id should <= r2id
-        if r1id > r2id:
-            r1id, r2id = r2id, r1id
-        # find which original datasets the rids belong to
-        ds1_offset = next(x for x in reversed(dataset_id_offset) if x <= r1id)
-        ds2_offset = next(x for x in reversed(dataset_id_offset) if x <= r2id)
-        # both are from one source (except only one dataset is provided)
-        if len(dataset_id_offset) > 1 and ds1_offset == ds2_offset:
+
+def iter_join(datasets: List[List[int]], t: float = 0, vec_len: int = 0, with_score: bool = False,
+              engine: str = None, stats: JoinStats = None) -> Iterator[Tuple]:
+    """
+    Same as `join`, but pairs are yielded as soon as they are verified instead of collected in a set.
+    With `with_score`, every pair is followed by its Jaccard similarity.
+    """
+    if not datasets:
+        return
+
+    started = time.perf_counter()
+    dataset, dataset_id_offset = concat_datasets(datasets)
+    records_sorted, original_order, order_map, meta = preprocess(dataset, vec_len, t)
+    if stats is not None:
+        stats.timings['preprocess'] += time.perf_counter() - started
+    sources = record_sources(original_order, dataset_id_offset)
+    for r1id, r2id in iter_compare(records_sorted, vec_len, t, order_map, engine, meta, stats, sources):
+        pair = map_pair(r1id, r2id, original_order, dataset_id_offset)
+        if pair is None:
             continue
+        if with_score:
+            r1, r2 = records_sorted[r1id], records_sorted[r2id]
+            yield pair + (jaccard(r1, r2, vec_len) if r1 | r2 else 0.0,)
+        else:
+            yield pair
+
+
+def lsh_join(datasets: List[List[int]], t: float = 0, vec_len: int = 0, bands: int = 32, rows: int = 4,
+             seed: int = 0, engine: str = None, stats: JoinStats = None) -> Set[Tuple[Tuple]]:
+    """
+    Approximate `join` with MinHash LSH candidates, see `iter_compare_lsh` and `lsh_recall`.
+    The result is a subset of `join`, `engine` only selects how the signatures are computed.
+    """
+    ret = set()
+    if not datasets:
+        return ret
 
-        ret.add((
-            (dataset_id_offset.index(ds1_offset), r1id - ds1_offset),
-            (dataset_id_offset.index(ds2_offset), r2id - ds2_offset)
-        ))
+    started = time.perf_counter()
+    dataset, dataset_id_offset = concat_datasets(datasets)
+    records_sorted, original_order, order_map, meta = preprocess(dataset, vec_len, t)
+    if stats is not None:
+        stats.timings['preprocess'] += time.perf_counter() - started
+    sources = record_sources(original_order, dataset_id_offset)
+    for r1id, r2id in iter_compare_lsh(records_sorted, vec_len, t, meta, bands, rows, seed, engine, stats, sources):
+        pair = map_pair(r1id, r2id, original_order, dataset_id_offset)
+        if pair is not None:
+            ret.add(pair)
 
     return ret
@@ -15,21 +15,95 @@ Licenced under the 2-clause BSD license ("Simplified BSD License" or "FreeBSD Li
 Code taken from https://github.com/teh/ppjoin
 """
 import collections
+import heapq
 import math
-from itertools import groupby, product
-from typing import List, Tuple, Set
+import mmap
+import struct
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import accumulate, groupby, islice
+from typing import Dict, Iterable, Iterator, List, Tuple, Set
+
+try:
+    import numpy as np
+    from ppjoin import _numba
+except ImportError:
+    np = _numba = None
 
 
 def ceil(x):
     return math.ceil(float('%.10f' % x))
 
 
-def prefix_length(s, threshold):
-    return len(s) - ceil(threshold*len(s)) + 1
+SIMILARITIES = ('jaccard', 'cosine', 'dice', 'overlap')
+
+
+def check_similarity(sim):
+    if sim not in SIMILARITIES:
+        raise ValueError('Unknown similarity function: {}, expected one of {}'.format(sim, ', '.join(SIMILARITIES)))
+
+
+def min_length(len_s, threshold, sim='jaccard'):
+    """
+    Smallest length of a record that can be similar to a longer (or equally long) record of length `len_s`.
+    """
+    if sim == 'jaccard':
+        return ceil(threshold * len_s)
+    if sim == 'cosine':
+        return ceil(threshold * threshold * len_s)
+    if sim == 'dice':
+        return ceil(threshold / (2.0 - threshold) * len_s)
+    return 1 if threshold > 0 else 0  # overlap coefficient does not depend on the longer record
+
+
+def prefix_length(s, threshold, sim='jaccard'):
+    """
+    Probing prefix: a record shares at least one token in this prefix with every shorter similar record.
+    """
+    if sim == 'overlap':
+        return len(s)
+    return len(s) - min_length(len(s), threshold, sim) + 1
+
 
+def index_prefix_length(s, threshold, sim='jaccard'):
+    """
+    Indexing prefix: a record shares at least one token in this prefix with every longer similar record.
+    It is never longer than `prefix_length`, since the required overlap only grows with the length of the other record.
+    """
+    return len(s) - overlap_constraint(len(s), len(s), threshold, sim) + 1
 
-def overlap_constraint(len_s1, len_s2, threshold):
-    return ceil(threshold / (1.0 + threshold) * (len_s1 + len_s2))
+
+def overlap_constraint(len_s1, len_s2, threshold, sim='jaccard'):
+    """
+    Minimum number of common tokens for two records to have similarity `threshold`.
+    """
+    if sim == 'jaccard':
+        return ceil(threshold / (1.0 + threshold) * (len_s1 + len_s2))
+    if sim == 'cosine':
+        return ceil(threshold * math.sqrt(len_s1 * len_s2))
+    if sim == 'dice':
+        return ceil(threshold / 2.0 * (len_s1 + len_s2))
+    return ceil(threshold * min(len_s1, len_s2))
+
+
+def similarity(len_s1, len_s2, overlap, sim='jaccard'):
+    """
+    Similarity of two records of the given lengths from their number of common tokens.
+    """
+    if not len_s1 or not len_s2:
+        return 0.0
+    if sim == 'jaccard':
+        return 1.0 * overlap / (len_s1 + len_s2 - overlap)
+    if sim == 'cosine':
+        return overlap / math.sqrt(len_s1 * len_s2)
+    if sim == 'dice':
+        return 2.0 * overlap / (len_s1 + len_s2)
+    return 1.0 * overlap / min(len_s1, len_s2)
 
 
 def jaccard(a, b):
@@ -40,80 +114,708 @@ def jaccard(a, b):
     return 1.0 * len(a & b) / len(a | b)
 
 
-def compare(records, t, order_map):
-    ii = collections.defaultdict(set)  # inverted index
-    cp = set()  # candidate pairs
+def cosine(a, b):
+    if not isinstance(a, set):
+        a = set(a)
+    if not isinstance(b, set):
+        b = set(b)
+    return len(a & b) / math.sqrt(len(a) * len(b))
+
+
+def dice(a, b):
+    if not isinstance(a, set):
+        a = set(a)
+    if not isinstance(b, set):
+        b = set(b)
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+
+def overlap_coefficient(a, b):
+    if not isinstance(a, set):
+        a = set(a)
+    if not isinstance(b, set):
+        b = set(b)
+    return 1.0 * len(a & b) / min(len(a), len(b))
+
+
+def weighted_jaccard(a, b, weights):
+    """
+    Jaccard similarity where every token counts with its weight, `weights` maps tokens to positive weights.
+    """
+    if not isinstance(a, set):
+        a = set(a)
+    if not isinstance(b, set):
+        b = set(b)
+    overlap = sum(weights[x] for x in a & b)
+    return overlap / (sum(weights[x] for x in a) + sum(weights[x] for x in b) - overlap)
+
+
+def merge_overlap(x, y, i=0, j=0, required=0):
+    """
+    Number of common tokens in x[i:] and y[j:], both sorted by rank.
+    Stops as soon as `required` common tokens can not be reached anymore,
+    the returned count is then lower than `required`.
+    """
+    overlap = 0
+    len_x, len_y = len(x), len(y)
+    while i < len_x and j < len_y:
+        if x[i] == y[j]:
+            overlap += 1
+            i += 1
+            j += 1
+        elif x[i] < y[j]:
+            i += 1
+            if overlap + len_x - i < required:
+                break
+        else:
+            j += 1
+            if overlap + len_y - j < required:
+                break
+    return overlap
+
+
+SUFFIX_FILTER_DEPTH = 2
+
+
+def suffix_filter(x, x_start, x_end, y, y_start, y_end, hmax, depth=1):
+    """
+    Suffix filter of PPJoin+.
+    Lower bound of the Hamming distance between x[x_start:x_end] and y[y_start:y_end] (both sorted by rank),
+    found by recursively splitting both at the middle token of y. It returns early once the bound exceeds `hmax`.
+    """
+    x_len, y_len = x_end - x_start, y_end - y_start
+    if not x_len or not y_len:
+        return x_len + y_len
+    if depth > SUFFIX_FILTER_DEPTH:
+        return abs(x_len - y_len)
+
+    mid = y_start + y_len // 2
+    w = y[mid]
+    p = bisect_left(x, w, x_start, x_end)
+    if p < x_end and x[p] == w:
+        xr_start, diff = p + 1, 0
+    else:
+        xr_start, diff = p, 1
+
+    # left parts are before w, right parts after it
+    left_diff, right_diff = abs((p - x_start) - (mid - y_start)), abs((x_end - xr_start) - (y_end - mid - 1))
+    h = left_diff + right_diff + diff
+    if h > hmax:
+        return h
+
+    hl = suffix_filter(x, x_start, p, y, y_start, mid, hmax - right_diff - diff, depth + 1)
+    h = hl + right_diff + diff
+    if h > hmax:
+        return h
+    hr = suffix_filter(x, xr_start, x_end, y, mid + 1, y_end, hmax - hl - diff, depth + 1)
+    return hl + hr + diff
+
+
+def length_lower_bound(records, start, t, sim='jaccard'):
+    """
+    Index of the first length-sorted record that can still pair with records[start:].
+    """
+    if start >= len(records):
+        return start
+    lo, hi = 0, start
+    min_len = min_length(len(records[start]), t, sim)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(records[mid]) < min_len:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class JoinStats(object):
+    """
+    Counters and timings of the filter stages.
+    Pass an instance as `stats` to `compare` or `join` to collect them, nothing is counted by default.
+    """
+
+    COUNTERS = ('probes', 'length_filtered', 'positional_filtered', 'suffix_filtered', 'verified', 'matches')
+
+    def __init__(self):
+        self.probes = 0  # inverted index entries scanned
+        self.length_filtered = 0  # entries dropped by the length filter
+        self.positional_filtered = 0  # entries dropped by the positional filter
+        self.suffix_filtered = 0  # candidates dropped by the suffix upper bound or the PPJoin+ suffix filter
+        self.verified = 0  # candidates verified
+        self.matches = 0  # verified pairs
+        self.timings = collections.defaultdict(float)  # stage -> seconds
+        self.partitions = []  # per band of `parallel_compare`: start, stop, cost, seconds, matches
+
+    def update(self, other: 'JoinStats') -> None:
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for stage, seconds in other.timings.items():
+            self.timings[stage] += seconds
+        self.partitions.extend(other.partitions)
+
+    def as_dict(self) -> dict:
+        ret = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        ret['timings'] = dict(self.timings)
+        if self.partitions:
+            ret['partitions'] = list(self.partitions)
+        return ret
+
+    def __repr__(self):
+        return 'JoinStats({})'.format(', '.join('{}={}'.format(k, v) for k, v in self.as_dict().items()))
+
+
+def compare(records, t, start=0, stop=None, stats=None, plus=False, sources=None, sim='jaccard', cross=False,
+            engine=None, with_overlap=False):
+    """
+    Find similar pairs (x, y) with y < x and x in [start, stop).
+    Records before `start` are only indexed, so a band of the length-sorted records
+    can be joined on its own and yields exactly its part of the full result.
+    With `plus`, the suffix filter of PPJoin+ is applied to new candidates.
+    If `sources` (the source dataset of every record) is given, only pairs from different sources are found:
+    every source has its own inverted index and records only probe the indexes of the other sources.
+    `sim` is one of `SIMILARITIES`, the prefix, length and overlap bounds of the filters follow it.
+    With `cross`, records in [start, stop) are not indexed, so only pairs with y < start are found.
+    `engine` is `python` or `numba` (see `iter_compare_numba`), by default numba is used if it is installed.
+    With `with_overlap`, triples (x, y, overlap) are returned with the number of common tokens counted by verification.
+    """
+    return set(iter_compare(records, t, start, stop, stats, plus, sources, sim, cross, engine, with_overlap))
+
+
+def iter_compare(records, t, start=0, stop=None, stats=None, plus=False, sources=None, sim='jaccard', cross=False,
+                 engine=None, with_overlap=False):
+    """
+    Generator version of `compare`, pairs are yielded as soon as they are verified.
+    """
+    if engine is None:
+        engine = 'python' if _numba is None else 'numba'
+    # inverted indexes: token -> [record, position, ...]
+    indexes = [collections.defaultdict(partial(array, 'i')) for _ in range(max(sources) + 1 if sources else 1)]
+    if stop is None:
+        stop = len(records)
 
     if t == 0:
-        return set(filter(lambda x: x[0] != x[1], product(range(len(records)), range(len(records)))))
+        pairs = ((x, y) for x in range(start, stop) for y in range(start if cross else x)
+                 if not sources or sources[x] != sources[y])
+        if with_overlap:
+            pairs = ((x, y, merge_overlap(records[x], records[y])) for x, y in pairs)
+        yield from pairs
+        return
+    if engine == 'numba':
+        yield from iter_compare_numba(records, t, start, stop, stats, plus, sources, sim, cross, with_overlap)
+        return
+    if engine != 'python':
+        raise ValueError('Unknown engine: {}'.format(engine))
 
-    for xr_index, xr in enumerate(records):
+    probes = length_filtered = positional_filtered = suffix_filtered = verified = matches = 0
+    timer = time.perf_counter if stats is not None else None
+
+    for xr_index in range(length_lower_bound(records, start, t, sim), stop):
+        xr = records[xr_index]
         if not xr:
             continue
-        xp = prefix_length(xr, t)
-        xp = min(xp, len(xr))
-        overlap_by_yr = collections.defaultdict(int)
+        xp = min(prefix_length(xr, t, sim), len(xr))  # probed
+        xi = min(index_prefix_length(xr, t, sim), xp)  # indexed, later records are never shorter
+        own = indexes[sources[xr_index]] if sources else indexes[0]
+        if xr_index < start:
+            for i in range(xi):
+                own[xr[i]].extend((xr_index, i))
+            continue
+        others = [ii for ii in indexes if ii is not own] if sources else indexes
+
+        if timer:
+            started = timer()
+        xr_len = len(xr)
+        min_len = min_length(xr_len, t, sim)
+        candidates = {}  # record -> [overlap, last matched position in xr, last matched position in yr], False if pruned
         for i in range(xp):
             xr_element = xr[i]
-            for yr_index, j in ii[xr_element]:
-                yr = records[yr_index]
-                if len(yr) < t * len(xr):
+            for ii in others:
+                postings = ii.get(xr_element)
+                if not postings:
                     continue
-                alpha = overlap_constraint(len(xr), len(yr), t)
-                upper_bound = 1 + min(len(xr) - i, len(yr) - j)
-                # count how many items of yr overlap xr:
-                if overlap_by_yr[yr_index] + upper_bound >= alpha:
-                    overlap_by_yr[yr_index] += 1
-                else:
-                    overlap_by_yr[yr_index] = 0
+                probes += len(postings) >> 1
+                it = iter(postings)
+                for yr_index, j in zip(it, it):
+                    yr_len = len(records[yr_index])
+                    if yr_len < min_len:
+                        length_filtered += 1
+                        continue
+                    c = candidates.get(yr_index)
+                    if c is False:
+                        continue
+                    overlap = c[0] if c else 0
+                    alpha = overlap_constraint(xr_len, yr_len, t, sim)
+                    # count how many items of yr overlap xr:
+                    if overlap + 1 + min(xr_len - i - 1, yr_len - j - 1) < alpha:
+                        candidates[yr_index] = False
+                        positional_filtered += 1
+                    elif c:
+                        c[0] += 1
+                        c[1], c[2] = i, j
+                    elif plus and suffix_filter(xr, i + 1, xr_len, records[yr_index], j + 1, yr_len,
+                                                xr_len + yr_len - i - j - 2 * alpha) > xr_len + yr_len - i - j - 2 * alpha:
+                        # xr[i+1:] and yr[j+1:] need at least alpha - 1 common tokens
+                        candidates[yr_index] = False
+                        suffix_filtered += 1
+                    else:
+                        candidates[yr_index] = [1, i, j]
 
-            ii[xr_element].add((xr_index, i))
+            if i < xi and not cross:
+                own[xr_element].extend((xr_index, i))
+        if timer:
+            probed = timer()
+            stats.timings['candidates'] += probed - started
 
         # check overlap in suffixes
-        for yr_index, overlap in overlap_by_yr.items():
+        for yr_index, c in candidates.items():
+            if c is False:
+                continue
+            overlap, i, j = c
             yr = records[yr_index]
-            yp = prefix_length(yr, t)
-            yp = min(yp, len(yr))
-            wx = xr[xp - 1]
-            wy = yr[yp - 1]
-            alpha = overlap_constraint(len(xr), len(yr), t)
-            rest = 0
+            alpha = overlap_constraint(xr_len, len(yr), t, sim)
+            if overlap + min(xr_len - i - 1, len(yr) - j - 1) < alpha:
+                suffix_filtered += 1
+                continue
 
-            if order_map[wx] < order_map[wy]:
-                ubound = overlap + len(xr) - xp
-                if ubound >= alpha:
-                    rest = len(set(yr[overlap:]) & set(xr[xp:]))
-            else:
-                ubound = overlap + len(yr) - yp
-                if ubound >= alpha:
-                    rest = len(set(xr[overlap:]) & set(yr[yp:]))
+            # all common tokens up to xr[i] == yr[j] have been counted from the prefixes,
+            # merging only stops early on pairs that can not reach alpha, so matches get their full overlap
+            verified += 1
+            overlap += merge_overlap(xr, yr, i + 1, j + 1, alpha - overlap)
+            if overlap >= alpha:
+                matches += 1
+                yield (xr_index, yr_index, overlap) if with_overlap else (xr_index, yr_index)
+
+        if timer:
+            stats.timings['verify'] += timer() - probed
+
+    if stats is not None:
+        stats.probes += probes
+        stats.length_filtered += length_filtered
+        stats.positional_filtered += positional_filtered
+        stats.suffix_filtered += suffix_filtered
+        stats.verified += verified
+        stats.matches += matches
+
+
+WEIGHT_TOLERANCE = 1e-9  # relative, absorbs rounding of the weight sums like `ceil` does for counts
+
+
+def suffix_weights(record, weights):
+    """
+    rest[i] is the total weight of record[i:], rest[len(record)] is 0.
+    """
+    rest = array('d', bytes(8 * (len(record) + 1)))
+    total = 0.0
+    for i in range(len(record) - 1, -1, -1):
+        total += weights[record[i]]
+        rest[i] = total
+    return rest
 
-            overlap += rest
+
+def iter_weighted_compare(records, weights, t, stats=None, sources=None):
+    """
+    Weighted version of `iter_compare`: yields similar pairs (x, y) with y < x by weighted Jaccard similarity.
+    `records` are sorted by total weight and `weights[rank]` is the weight of a token rank, see `weighted_preprocess`.
+    A position is in the prefix as long as the weight from it to the end of the record can still reach the required overlap,
+    the length filter compares total weights and the positional filter the remaining weights of both records.
+    """
+    indexes = [collections.defaultdict(partial(array, 'i')) for _ in range(max(sources) + 1 if sources else 1)]
+
+    if t == 0:
+        yield from ((x, y) for x in range(len(records)) for y in range(x) if not sources or sources[x] != sources[y])
+        return
+
+    probes = length_filtered = positional_filtered = suffix_filtered = verified = matches = 0
+    timer = time.perf_counter if stats is not None else None
+    keep = 1 - WEIGHT_TOLERANCE
+    rests = []
+
+    for xr_index, xr in enumerate(records):
+        xr_rest = suffix_weights(xr, weights)
+        rests.append(xr_rest)
+        if not xr:
+            continue
+        xr_weight = xr_rest[0]
+        min_weight = t * xr_weight * keep
+        index_weight = 2 * t / (1 + t) * xr_weight * keep  # later records are never lighter
+        own = indexes[sources[xr_index]] if sources else indexes[0]
+        others = [ii for ii in indexes if ii is not own] if sources else indexes
+
+        if timer:
+            started = timer()
+        xr_len = len(xr)
+        candidates = {}  # record -> [overlap weight, last matched position in xr, last matched position in yr], False if pruned
+        for i in range(xr_len):
+            if xr_rest[i] < min_weight:
+                break
+            xr_element = xr[i]
+            w = weights[xr_element]
+            for ii in others:
+                postings = ii.get(xr_element)
+                if not postings:
+                    continue
+                probes += len(postings) >> 1
+                it = iter(postings)
+                for yr_index, j in zip(it, it):
+                    yr_rest = rests[yr_index]
+                    if yr_rest[0] < min_weight:
+                        length_filtered += 1
+                        continue
+                    c = candidates.get(yr_index)
+                    if c is False:
+                        continue
+                    overlap = c[0] if c else 0.0
+                    alpha = t / (1 + t) * (xr_weight + yr_rest[0]) * keep
+                    if overlap + w + min(xr_rest[i + 1], yr_rest[j + 1]) < alpha:
+                        candidates[yr_index] = False
+                        positional_filtered += 1
+                    elif c:
+                        c[0] += w
+                        c[1], c[2] = i, j
+                    else:
+                        candidates[yr_index] = [w, i, j]
+
+            if xr_rest[i] >= index_weight:
+                own[xr_element].extend((xr_index, i))
+        if timer:
+            probed = timer()
+            stats.timings['candidates'] += probed - started
+
+        for yr_index, c in candidates.items():
+            if c is False:
+                continue
+            overlap, i, j = c
+            yr = records[yr_index]
+            yr_rest = rests[yr_index]
+            alpha = t / (1 + t) * (xr_weight + yr_rest[0]) * keep
+            if overlap + min(xr_rest[i + 1], yr_rest[j + 1]) < alpha:
+                suffix_filtered += 1
+                continue
+
+            verified += 1
+            i += 1
+            j += 1
+            yr_len = len(yr)
+            while i < xr_len and j < yr_len:
+                if xr[i] == yr[j]:
+                    overlap += weights[xr[i]]
+                    i += 1
+                    j += 1
+                elif xr[i] < yr[j]:
+                    i += 1
+                else:
+                    j += 1
+                if overlap + min(xr_rest[i], yr_rest[j]) < alpha:
+                    break
             if overlap >= alpha:
-                cp.add((xr_index, yr_index))
+                matches += 1
+                yield xr_index, yr_index
+
+        if timer:
+            stats.timings['verify'] += timer() - probed
+
+    if stats is not None:
+        stats.probes += probes
+        stats.length_filtered += length_filtered
+        stats.positional_filtered += positional_filtered
+        stats.suffix_filtered += suffix_filtered
+        stats.verified += verified
+        stats.matches += matches
+
+
+NUMBA_BLOCK_SIZE = 4096  # records probed per kernel call, pairs are yielded after every block
+
+_Packed = collections.namedtuple('Packed', ['tokens', 'offsets', 'n_tokens'])
+
+
+def _pack_numba(records=None, tokens=None, offsets=None):
+    """
+    The int32 tokens, int64 offsets and vocabulary size the numba kernels run on,
+    packed from `records` or wrapping the buffers of `pack_records` without a copy.
+    """
+    if records is not None:
+        tokens, offsets = pack_records(records)
+    tokens = np.frombuffer(tokens, np.int32) if len(tokens) else np.empty(0, np.int32)
+    offsets = np.frombuffer(offsets, np.int64)
+    return _Packed(tokens, offsets, int(tokens.max()) + 1 if len(tokens) else 0)
 
+
+def iter_compare_numba(records, t, start=0, stop=None, stats=None, plus=False, sources=None, sim='jaccard',
+                       cross=False, with_overlap=False):
+    """
+    `iter_compare` with the compiled kernels of `ppjoin._numba` over the packed records,
+    it yields the same pairs in the same order and counts the same filter statistics.
+    `records` can also be the result of `_pack_numba`, so that bands of the same records are packed only once.
+    """
+    if _numba is None:
+        raise ImportError('The numba engine requires numba, install it with `pip install numba`')
+    packed = records if isinstance(records, _Packed) else _pack_numba(records)
+    tokens, offsets = packed.tokens, packed.offsets
+    n = len(offsets) - 1
+    if stop is None:
+        stop = n
+    if start >= stop:
+        return
+    # `length_lower_bound` on the lengths of the records before start
+    min_len = min_length(int(offsets[start + 1] - offsets[start]), t, sim)
+    lo = int(np.searchsorted(np.diff(offsets[:start + 1]), min_len))
+
+    sources = np.asarray(sources, dtype=np.int32) if sources is not None and len(sources) else np.empty(0, np.int32)
+    code = _numba.SIM_CODES[sim]
+    counters = np.zeros(len(JoinStats.COUNTERS), np.int64)
+    bound = start if cross else stop
+
+    started = time.perf_counter()
+    ii_offsets, ii_records, ii_positions = _numba.build_index(tokens, offsets, lo, bound, t, code, packed.n_tokens)
+    workspace = _numba.workspace(n)
+    for first in range(start, stop, NUMBA_BLOCK_SIZE):
+        candidates = _numba.candidates(tokens, offsets, sources, t, code, plus, SUFFIX_FILTER_DEPTH,
+                                       first, min(first + NUMBA_BLOCK_SIZE, stop), bound,
+                                       ii_offsets, ii_records, ii_positions, counters, *workspace)
+        probed = time.perf_counter()
+        matched = _numba.verify(tokens, offsets, t, code, candidates, counters)
+        if stats is not None:
+            stats.timings['candidates'] += probed - started
+            stats.timings['verify'] += time.perf_counter() - probed
+        yield from map(tuple, candidates[matched, :3 if with_overlap else 2].tolist())
+        started = time.perf_counter()
+
+    if stats is not None:
+        for name, count in zip(JoinStats.COUNTERS, counters.tolist()):
+            setattr(stats, name, getattr(stats, name) + count)
+
+
+_worker_records = None
+_worker_sources = None
+
+
+def _init_worker(tokens, offsets, sources, packed=False):
+    global _worker_records, _worker_sources
+    _worker_records = _pack_numba(tokens=tokens, offsets=offsets) if packed else unpack_records(tokens, offsets)
+    _worker_sources = sources
+
+
+def _compare_band(t, start, stop, with_stats, plus, sim, engine, with_overlap, records=None, sources=None):
+    """
+    `compare` on one band, on the worker's records unless `records` are given (thread pools share them).
+    Records packed by `_pack_numba` go straight to the numba kernels.
+    """
+    if records is None:
+        records, sources = _worker_records, _worker_sources
+    stats = JoinStats() if with_stats else None
+    started = time.perf_counter()
+    if isinstance(records, _Packed):
+        cp = set(iter_compare_numba(records, t, start, stop, stats, plus, sources, sim, with_overlap=with_overlap))
+    else:
+        cp = compare(records, t, start, stop, stats, plus, sources, sim, engine=engine, with_overlap=with_overlap)
+    return cp, stats, time.perf_counter() - started
+
+
+def estimate_costs(records, t, sim='jaccard', with_index=False):
+    """
+    Estimated cost of joining every length-sorted record with the records before it:
+    the inverted index entries its prefix probes, counted from the token frequencies of the earlier indexing prefixes,
+    plus its length for verification.
+    Sources are ignored, so with several datasets this is an upper bound.
+    With `with_index`, the cost of only indexing every record (its indexing prefix plus one) is returned as well,
+    which a band pays for every record of its window (see `partition`).
+    """
+    counts = collections.Counter()
+    costs = array('d')
+    index_costs = array('d')
+    for xr in records:
+        xr_len = len(xr)
+        if not xr_len or t == 0:
+            costs.append(xr_len + 1)
+            index_costs.append(0)
+            continue
+        xp = min(prefix_length(xr, t, sim), xr_len)
+        xi = min(index_prefix_length(xr, t, sim), xp)
+        costs.append(sum(counts[xr[i]] for i in range(xp)) + xr_len)
+        index_costs.append(xi + 1)
+        counts.update(xr[:xi])
+    if with_index:
+        return costs, index_costs
+    return costs
+
+
+def _band_cost(records, t, start, stop, sim, cumulative, indexed):
+    """
+    Estimated cost of the band [start, stop) from the cumulative sums (with a leading 0) of both `estimate_costs`:
+    its own records plus indexing the window of shorter records before `start` the length filter leaves.
+    """
+    return cumulative[stop] - cumulative[start] + indexed[start] - indexed[length_lower_bound(records, start, t, sim)]
+
+
+def partition(records, t, parts, sim='jaccard', costs=None):
+    """
+    Cut the length-sorted records into at most `parts` bands [start, stop) of about the same estimated cost.
+    Every band is joined with the window of shorter records the length filter leaves and indexes that window again,
+    so the cost of a band is that of its records plus the indexing of its window (see `_band_cost`).
+    Skewed length distributions give short bands of long records and long bands of short records.
+    `costs` is the result of `estimate_costs(records, t, sim, with_index=True)`, computed if not given.
+    """
+    if costs is None:
+        costs = estimate_costs(records, t, sim, with_index=True)
+    cumulative, indexed = ([0.0] + list(accumulate(c)) for c in costs)
+    n = len(records)
+
+    def cut(target):
+        # greedy bands, each up to the first record that brings it to `target`, None if more than `parts` are needed
+        bands = []
+        start = 0
+        while start < n:
+            if len(bands) == parts:
+                return None
+            window = _band_cost(records, t, start, start, sim, cumulative, indexed)
+            stop = min(max(bisect_left(cumulative, cumulative[start] + target - window, start + 1), start + 1), n)
+            bands.append((start, stop))
+            start = stop
+        return bands
+
+    # smallest target that needs at most `parts` bands
+    lo, hi = 0.0, _band_cost(records, t, 0, n, sim, cumulative, indexed)
+    best = cut(hi)
+    for _ in range(50):
+        if hi - lo <= 1:
+            break
+        mid = (lo + hi) / 2
+        bands = cut(mid)
+        if bands is None:
+            lo = mid
+        else:
+            hi, best = mid, bands
+    return best
+
+
+def parallel_compare(records, t, workers, stats=None, plus=False, sources=None, sim='jaccard', engine=None,
+                     executor='process', parts=None, with_overlap=False):
+    """
+    Run `compare` on length bands of the sorted records in a pool of `workers`.
+    The records are cut into `parts` bands (by default 4 per worker) of about the same estimated cost,
+    which are handed out most expensive first, so a worker that finishes early takes the next band.
+    `executor` is `process` (every worker gets the packed records once) or `thread`
+    (records are shared, only worth it when the engine releases the GIL, as the numba engine does).
+    With the numba engine the records are packed once for all bands.
+    With `stats`, the counters are merged and the start, stop, estimated cost, seconds and matches
+    of every band are added to `stats.partitions` in band order.
+    The merged result is identical to `compare(records, t, with_overlap=with_overlap)`.
+    """
+    if not records:
+        return set()
+    costs = estimate_costs(records, t, sim, with_index=True)
+    bands = partition(records, t, parts or 4 * workers, sim, costs)
+    cumulative, indexed = ([0.0] + list(accumulate(c)) for c in costs)
+    band_costs = [_band_cost(records, t, start, stop, sim, cumulative, indexed) for start, stop in bands]
+    packed = t > 0 and _numba is not None and engine in (None, 'numba')
+    if packed and sources:
+        sources = np.asarray(sources, dtype=np.int32)
+    if executor == 'process':
+        tokens, offsets = pack_records(records)
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(tokens, offsets, sources, packed))
+        shared = ()
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+        shared = (_pack_numba(records) if packed else records, sources)
+    else:
+        raise ValueError('Unknown executor: {}'.format(executor))
+
+    cp = set()
+    reports = [None] * len(bands)
+    with pool:
+        futures = {}
+        for b in sorted(range(len(bands)), key=band_costs.__getitem__, reverse=True):
+            start, stop = bands[b]
+            futures[pool.submit(_compare_band, t, start, stop, stats is not None, plus, sim, engine, with_overlap,
+                                *shared)] = b
+        for f in as_completed(futures):
+            band_cp, band_stats, seconds = f.result()
+            cp |= band_cp
+            if stats is not None:
+                b = futures[f]
+                stats.update(band_stats)
+                reports[b] = {'start': bands[b][0], 'stop': bands[b][1], 'cost': band_costs[b],
+                              'seconds': seconds, 'matches': len(band_cp)}
+    if stats is not None:
+        stats.partitions.extend(reports)
     return cp
 
 
+def pack_records(records):
+    """
+    Pack integer records into one contiguous buffer.
+    Record i is `tokens[offsets[i]:offsets[i+1]]`.
+    """
+    tokens = array('i')
+    offsets = array('q', [0])
+    for r in records:
+        tokens.extend(r)
+        offsets.append(len(tokens))
+    return tokens, offsets
+
+
+def unpack_records(tokens, offsets):
+    """
+    Zero-copy views of every record in a packed buffer.
+    """
+    view = memoryview(tokens)
+    return [view[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
 def preprocess(records):
     # records = list(map(lambda x: normalize_words(x), records))
 
-    # sort records
-    argsort = sorted(range(len(records)), key=lambda x: len(records[x]))
-    records.sort(key=len)
-
-    # sort tokens
-    elements = list(y for r in records for y in r)
+    # sort tokens, rarest first
     order_map = dict(
         (el, i)
-        for i, (el, count) in enumerate(sorted(collections.Counter(elements).items(), key=lambda x: (x[1], x[0])))
+        for i, (el, count) in enumerate(sorted(collections.Counter(y for r in records for y in r).items(),
+                                               key=lambda x: (x[1], x[0])))
     )
 
-    records_sorted = [sorted(x, key=lambda x: order_map[x]) for x in records]
+    # encode every record as its sorted, deduplicated token ranks
+    ranked = [sorted(set(order_map[x] for x in r)) for r in records]
+
+    # sort records
+    argsort = sorted(range(len(ranked)), key=lambda x: len(ranked[x]))
+    tokens, offsets = pack_records(ranked[i] for i in argsort)
+    records_sorted = unpack_records(tokens, offsets)
 
     return records_sorted, argsort, order_map
 
 
+def weighted_preprocess(records, weights='idf'):
+    """
+    Like `preprocess`, but tokens are ranked by decreasing weight and records are sorted by total weight.
+    `weights` is 'idf' (log(1 + number of records / document frequency)) or a dict of positive token weights,
+    tokens missing from it weigh 1.
+    Returns the sorted records, their original order, the token ranks and the weight of every rank.
+    """
+    df = collections.Counter(y for r in records for y in set(r))
+    if weights == 'idf':
+        n = len(records)
+        token_weight = dict((el, math.log(1.0 + 1.0 * n / count)) for el, count in df.items())
+    elif isinstance(weights, dict):
+        token_weight = dict((el, float(weights.get(el, 1.0))) for el in df)
+        if any(w <= 0 for w in token_weight.values()):
+            raise ValueError('Token weights must be positive')
+    else:
+        raise ValueError("weights must be 'idf' or a dict of token weights")
+
+    # heaviest (rarest) first, so that prefixes stay short
+    order = sorted(df, key=lambda x: (-token_weight[x], x))
+    order_map = dict((el, i) for i, el in enumerate(order))
+    rank_weights = array('d', (token_weight[el] for el in order))
+
+    ranked = [sorted(set(order_map[x] for x in r)) for r in records]
+    record_weights = [sum(rank_weights[x] for x in r) for r in ranked]
+    argsort = sorted(range(len(ranked)), key=lambda x: record_weights[x])
+    tokens, offsets = pack_records(ranked[i] for i in argsort)
+    records_sorted = unpack_records(tokens, offsets)
+
+    return records_sorted, argsort, order_map, rank_weights
+
+
 # def normalize_words(words):
 #     """
 #     Normalize same words in document to unique words tokens as described in
@@ -132,23 +834,131 @@ def qgram_tokenizer(n, s, place_holder=' ', padded=False):
     if padded:
         pad = place_holder * (n - 1)
         s = pad + s + pad
-    s = s.split(' ')
-    s = place_holder.join(s)
+    if place_holder != ' ':
+        s = s.replace(' ', place_holder)
     if len(s) < n:
         return [s]
     return [s[i:i + n] for i in range(len(s) - n + 1)]
 
 
 def whitespace_tokenizer(x):
-    return list(filter(lambda t: t is not None, x.split(' ')))
+    return [t for t in x.split(' ') if t]
 
 
-def join(datasets: List[List[List[str]]], t: float = 0) -> Set[Tuple[Tuple]]:
+def hash_token(token):
+    """
+    Stable 31-bit id of a token, identical across processes and runs (unlike `hash`).
+    """
+    return zlib.crc32(token.encode('utf-8')) & 0x7fffffff
+
+
+HASH_CACHE_SIZE = 2 ** 20
+
+
+class _HashCache(dict):
+
+    def __missing__(self, token):
+        h = self[token] = hash_token(token)
+        return h
+
+
+def _tokenize_chunk(chunk, tokenizer, q, padded, hashing):
+    """
+    Deduplicated tokens of every string, or their sorted hash ids if `hashing`.
+    """
+    if tokenizer == 'qgram':
+        split = partial(qgram_tokenizer, q, padded=padded)
+    elif tokenizer == 'whitespace':
+        split = whitespace_tokenizer
+    else:
+        split = tokenizer
+    if not hashing:
+        # in order of first occurrence, so that vocabulary ids do not depend on set order or on the process
+        return [list(dict.fromkeys(split(s))) for s in chunk]
+
+    ret = []
+    cache = _HashCache()
+    for s in chunk:
+        if len(cache) >= HASH_CACHE_SIZE:
+            cache.clear()
+        ret.append(array('i', sorted(set(map(cache.__getitem__, split(s))))))
+    return ret
 
-    ret = set()
-    if not datasets:
-        return ret
 
+def _string_chunks(strings, chunk_size):
+    it = iter(strings)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_tokenize(strings: Iterable[str], tokenizer='whitespace', q: int = 3, padded: bool = False,
+                  vocab: dict = None, hashing: bool = False, workers: int = 1,
+                  chunk_size: int = 10000) -> Iterator[array]:
+    """
+    Tokenize a stream of strings into sorted, deduplicated integer token ids, ready for `join`.
+
+    `tokenizer` is 'whitespace', 'qgram' (with `q` and `padded`, see `qgram_tokenizer`)
+    or a function from a string to its tokens (picklable if `workers` > 1).
+    Tokens get consecutive ids from `vocab` (token -> id, updated in place, so datasets joined together
+    should share it), or stable hash ids (see `hash_token`) if `hashing`, which needs no shared state.
+    With `workers` > 1, chunks of `chunk_size` strings are tokenized in a process pool,
+    only a few chunks are in flight at a time so the input can be a stream of any size.
+    """
+    if vocab is None:
+        vocab = {}
+    tokenize_chunk = partial(_tokenize_chunk, tokenizer=tokenizer, q=q, padded=padded, hashing=hashing)
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        pending = collections.deque()
+
+        def results():
+            for chunk in _string_chunks(strings, chunk_size):
+                pending.append(executor.submit(tokenize_chunk, chunk))
+                if len(pending) > 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    else:
+        executor = None
+
+        def results():
+            for chunk in _string_chunks(strings, chunk_size):
+                yield tokenize_chunk(chunk)
+
+    try:
+        for chunk in results():
+            if hashing:
+                yield from chunk
+                continue
+            for tokens in chunk:
+                ids = list(map(vocab.get, tokens))
+                if None in ids:
+                    for k, token in enumerate(tokens):
+                        if ids[k] is None:
+                            ids[k] = vocab[token] = len(vocab)
+                ids.sort()
+                yield array('i', ids)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def tokenize(strings: Iterable[str], tokenizer='whitespace', q: int = 3, padded: bool = False,
+             vocab: dict = None, hashing: bool = False, workers: int = 1, chunk_size: int = 10000) -> List[array]:
+    """
+    List version of `iter_tokenize`.
+    """
+    return list(iter_tokenize(strings, tokenizer, q, padded, vocab, hashing, workers, chunk_size))
+
+
+def concat_datasets(datasets):
+    """
+    Concatenate datasets and return the start offset of each one.
+    """
     dataset = []
     dataset_id_offset = [0]
     for d in datasets:
@@ -156,27 +966,613 @@ def join(datasets: List[List[List[str]]], t: float = 0) -> Set[Tuple[Tuple]]:
         dataset_id_offset.append(len(d) + dataset_id_offset[-1])
     if len(dataset_id_offset) > 1:
         dataset_id_offset = dataset_id_offset[:-1]
- 
-    records_sorted, original_order, order_map = preprocess(dataset)
-    result = compare(records_sorted, t, order_map)
-    for r in result:
-        r1id, r2id = r[0], r[1]
-        r1id, r2id = original_order[r1id], original_order[r2id]
-        if r1id == r2id:
+    return dataset, dataset_id_offset
+
+
+def map_pair(r1id, r2id, original_order, dataset_id_offset):
+    """
+    Map a pair of sorted record indices back to ((dataset index, record index), (dataset index, record index)).
+    Returns None if the pair has to be dropped.
+    """
+    r1id, r2id = original_order[r1id], original_order[r2id]
+    if r1id == r2id:
+        return None
+
+    # r1id should <= r2id
+    if r1id > r2id:
+        r1id, r2id = r2id, r1id
+    # find which original datasets the rids belong to
+    ds1 = bisect_right(dataset_id_offset, r1id) - 1
+    ds2 = bisect_right(dataset_id_offset, r2id) - 1
+    # both are from one source (except only one dataset is provided)
+    if len(dataset_id_offset) > 1 and ds1 == ds2:
+        return None
+
+    return (ds1, r1id - dataset_id_offset[ds1]), (ds2, r2id - dataset_id_offset[ds2])
+
+
+def record_sources(original_order, dataset_id_offset):
+    """
+    Source dataset of every sorted record, None if there is only one dataset (self-join).
+    """
+    if len(dataset_id_offset) < 2:
+        return None
+    return array('i', (bisect_right(dataset_id_offset, rid) - 1 for rid in original_order))
+
+
+def collapse_duplicates(records, sources=None):
+    """
+    Collapse identical length-sorted records of the same source into the first of them.
+    Returns the indices of the representatives and, for every representative, the indices of its duplicates
+    (itself included). Records are only compared with records of the same length, so one length is hashed at a time.
+    """
+    representatives = array('q')
+    members = []
+    for _, group in groupby(range(len(records)), key=lambda i: len(records[i])):
+        first = {}  # (source, tokens) -> representative
+        for i in group:
+            r = records[i]
+            key = (sources[i] if sources else 0, r.tobytes() if isinstance(r, memoryview) else tuple(r))
+            k = first.get(key)
+            if k is None:
+                first[key] = len(members)
+                representatives.append(i)
+                members.append([i])
+            else:
+                members[k].append(i)
+    return representatives, members
+
+
+def expand_duplicates(pairs, records, members, t, sources=None):
+    """
+    Expand pairs (x, y) of representatives from `collapse_duplicates` to all pairs of their duplicates,
+    after the pairs within every group of duplicates (similarity 1, except for empty records).
+    Indices are those of the records before collapsing.
+    """
+    if not sources:
+        for group in members:
+            if len(group) > 1 and (t == 0 or len(records[group[0]])):
+                for n, y in enumerate(group):
+                    for x in group[n + 1:]:
+                        yield x, y
+    for x, y in pairs:
+        for i in members[x]:
+            for j in members[y]:
+                yield i, j
+
+
+def _collapse(records, sources):
+    """
+    Representative records and sources of `collapse_duplicates`, and the duplicates of every representative.
+    """
+    representatives, members = collapse_duplicates(records, sources)
+    if sources:
+        sources = array('i', (sources[i] for i in representatives))
+    return [records[i] for i in representatives], sources, members
+
+
+def check_weighted(sim, workers=1, plus=False):
+    if sim != 'jaccard':
+        raise ValueError('Weighted joins only support jaccard similarity')
+    if workers > 1 or plus:
+        raise ValueError('Weighted joins do not support workers or plus')
+
+
+_Prepared = collections.namedtuple('Prepared', ['records_sorted', 'original_order', 'dataset_id_offset', 'sources',
+                                                'rank_weights', 'records', 'rep_sources', 'members'])
+
+
+def _prepare(datasets, sim='jaccard', stats=None, weights=None, dedup=False, workers=1, plus=False):
+    """
+    Setup shared by the join entry points: check the arguments, concatenate and preprocess the datasets
+    (with `weighted_preprocess` if `weights` are given) and find the source of every sorted record.
+    `records` and `rep_sources` are what gets compared: the representatives of `_collapse` with `dedup`,
+    otherwise the sorted records themselves. Returns None if there are no datasets.
+    """
+    check_similarity(sim)
+    if weights is not None:
+        check_weighted(sim, workers, plus)
+    if not datasets:
+        return None
+
+    started = time.perf_counter()
+    dataset, dataset_id_offset = concat_datasets(datasets)
+    rank_weights = None
+    if weights is not None:
+        records_sorted, original_order, order_map, rank_weights = weighted_preprocess(dataset, weights)
+    else:
+        records_sorted, original_order, order_map = preprocess(dataset)
+    if stats is not None:
+        stats.timings['preprocess'] += time.perf_counter() - started
+    sources = record_sources(original_order, dataset_id_offset)
+    records, rep_sources, members = _collapse(records_sorted, sources) if dedup else (records_sorted, sources, None)
+    return _Prepared(records_sorted, original_order, dataset_id_offset, sources, rank_weights, records, rep_sources,
+                    members)
+
+
+def _compare_prepared(prepared, t, workers=1, stats=None, plus=False, sim='jaccard', engine=None, executor='process',
+                      with_overlap=False):
+    """
+    Pairs of `prepared.records`, from the weighted, parallel or serial compare.
+    """
+    if prepared.rank_weights is not None:
+        return iter_weighted_compare(prepared.records, prepared.rank_weights, t, stats, prepared.rep_sources)
+    if workers > 1:
+        return parallel_compare(prepared.records, t, workers, stats, plus, prepared.rep_sources, sim, engine, executor,
+                                with_overlap=with_overlap)
+    return iter_compare(prepared.records, t, stats=stats, plus=plus, sources=prepared.rep_sources, sim=sim,
+                        engine=engine, with_overlap=with_overlap)
+
+
+def join(datasets: List[List[List[str]]], t: float = 0, workers: int = 1,
+         stats: JoinStats = None, plus: bool = False, sim: str = 'jaccard', weights=None,
+         engine: str = None, executor: str = 'process', dedup: bool = False) -> Set[Tuple[Tuple]]:
+
+    ret = set()
+    prepared = _prepare(datasets, sim, stats, weights, dedup, workers, plus)
+    if prepared is None:
+        return ret
+
+    result = _compare_prepared(prepared, t, workers, stats, plus, sim, engine, executor)
+    if dedup:
+        result = expand_duplicates(result, prepared.records_sorted, prepared.members, t, prepared.sources)
+    for r1id, r2id in result:
+        pair = map_pair(r1id, r2id, prepared.original_order, prepared.dataset_id_offset)
+        if pair is not None:
+            ret.add(pair)
+
+    return ret
+
+
+def iter_join(datasets: List[List[List[str]]], t: float = 0, with_score: bool = False,
+              stats: JoinStats = None, plus: bool = False, sim: str = 'jaccard', weights=None,
+              engine: str = None, dedup: bool = False) -> Iterator[Tuple]:
+    """
+    Same as `join`, but pairs are yielded as soon as they are verified instead of collected in a set.
+    With `with_score`, every pair is followed by its similarity.
+    """
+    prepared = _prepare(datasets, sim, stats, weights, dedup, plus=plus)
+    if prepared is None:
+        return
+
+    records_sorted, rank_weights = prepared.records_sorted, prepared.rank_weights
+    result = _compare_prepared(prepared, t, stats=stats, plus=plus, sim=sim, engine=engine)
+    if dedup:
+        result = expand_duplicates(result, records_sorted, prepared.members, t, prepared.sources)
+    for r1id, r2id in result:
+        pair = map_pair(r1id, r2id, prepared.original_order, prepared.dataset_id_offset)
+        if pair is None:
             continue
+        if with_score and weights is not None:
+            r1, r2 = records_sorted[r1id], records_sorted[r2id]
+            overlap = sum(rank_weights[x] for x in set(r1).intersection(r2))
+            union = sum(rank_weights[x] for x in r1) + sum(rank_weights[x] for x in r2) - overlap
+            yield pair + (overlap / union if union else 0.0,)
+        elif with_score:
+            r1, r2 = records_sorted[r1id], records_sorted[r2id]
+            yield pair + (similarity(len(r1), len(r2), merge_overlap(r1, r2), sim),)
+        else:
+            yield pair
 
-        # r1id should <= r2id
-        if r1id > r2id:
-            r1id, r2id = r2id, r1id
-        # find which original datasets the rids belong to
-        ds1_offset = next(x for x in reversed(dataset_id_offset) if x <= r1id)
-        ds2_offset = next(x for x in reversed(dataset_id_offset) if x <= r2id)
-        # both are from one source (except only one dataset is provided)
-        if len(dataset_id_offset) > 1 and ds1_offset == ds2_offset:
+
+def join_groups(datasets: List[List[List[str]]], t: float = 0, workers: int = 1, stats: JoinStats = None,
+                plus: bool = False, sim: str = 'jaccard', weights=None, engine: str = None,
+                executor: str = 'process') -> Tuple[List[List[Tuple]], Set[Tuple]]:
+    """
+    Compact form of `join(..., dedup=True)` without expanding duplicates.
+    Returns the groups of identical records of a dataset, as lists of (dataset index, record index),
+    and the pairs (group index, group index) of similar groups.
+    Records within a non-empty group are similar to each other, a pair of groups stands for all pairs of their records.
+    """
+    prepared = _prepare(datasets, sim, stats, weights, True, workers, plus)
+    if prepared is None:
+        return [], set()
+
+    result = _compare_prepared(prepared, t, workers, stats, plus, sim, engine, executor)
+    pairs = set((y, x) for x, y in result)
+
+    groups = []
+    offsets = prepared.dataset_id_offset
+    for group in prepared.members:
+        ids = []
+        for i in group:
+            rid = prepared.original_order[i]
+            ds = bisect_right(offsets, rid) - 1
+            ids.append((ds, rid - offsets[ds]))
+        groups.append(ids)
+    return groups, pairs
+
+
+def cluster(datasets: List[List[List[str]]], t: float = 0, stats: JoinStats = None, plus: bool = False,
+            sim: str = 'jaccard', weights=None, engine: str = None, dedup: bool = False) -> List[array]:
+    """
+    Connected components of the pairs `join` would return, as an array of cluster ids for every dataset.
+    Pairs are merged into a union-find forest over all records (path halving, the smaller root wins)
+    as they stream out of `iter_compare` and are never stored.
+    Cluster ids are numbered in order of the first record of every cluster, records without a pair get their own.
+    With `dedup`, identical records are linked directly instead of joining and expanding every copy.
+    """
+    prepared = _prepare(datasets, sim, stats, weights, dedup, plus=plus)
+    if prepared is None:
+        return []
+
+    original_order, members = prepared.original_order, prepared.members
+    n = len(original_order)
+    parent = array('q', range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(x, y):
+        x, y = find(x), find(y)
+        if x < y:
+            parent[y] = x
+        elif y < x:
+            parent[x] = y
+
+    result = _compare_prepared(prepared, t, stats=stats, plus=plus, sim=sim, engine=engine)
+    if dedup:
+        # copies are pairs of each other in a self-join, otherwise only through a pair of their group
+        linked = bytearray(len(members))
+
+        def link(group):
+            if not linked[group]:
+                linked[group] = 1
+                first = original_order[members[group][0]]
+                for i in members[group][1:]:
+                    union(first, original_order[i])
+
+        if not prepared.sources:
+            for group in range(len(members)):
+                if t == 0 or len(prepared.records[group]):
+                    link(group)
+        for x, y in result:
+            link(x)
+            link(y)
+            union(original_order[members[x][0]], original_order[members[y][0]])
+    else:
+        for x, y in result:
+            union(original_order[x], original_order[y])
+
+    # roots are the smallest record of their cluster, so they are numbered before their other records
+    labels = array('q')
+    n_clusters = 0
+    for i in range(n):
+        root = find(i)
+        if root < i:
+            labels.append(labels[root])
+        else:
+            labels.append(n_clusters)
+            n_clusters += 1
+    offsets = prepared.dataset_id_offset
+    return [labels[start:end] for start, end in zip(offsets, list(offsets[1:]) + [n])]
+
+
+def join_multi(datasets: List[List[List[str]]], thresholds: List[float], workers: int = 1, stats: JoinStats = None,
+               plus: bool = False, sim: str = 'jaccard', engine: str = None,
+               executor: str = 'process') -> Dict[float, Set[Tuple[Tuple]]]:
+    """
+    Join once at the lowest threshold and return the result of `join` for every threshold.
+    The overlap every pair was verified with is compared with the required overlap of each threshold,
+    so pairs are not merged again.
+    """
+    thresholds = sorted(set(thresholds))
+    ret = dict((t, set()) for t in thresholds)
+    prepared = _prepare(datasets if thresholds else [], sim, stats)
+    if prepared is None:
+        return ret
+
+    records_sorted = prepared.records_sorted
+    result = _compare_prepared(prepared, thresholds[0], workers, stats, plus, sim, engine, executor, with_overlap=True)
+    for r1id, r2id, overlap in result:
+        pair = map_pair(r1id, r2id, prepared.original_order, prepared.dataset_id_offset)
+        if pair is None:
             continue
+        r1, r2 = records_sorted[r1id], records_sorted[r2id]
+        for t in thresholds:
+            # the required overlap grows with the threshold, records without tokens only pair at t = 0
+            if t > 0 and (not r1 or not r2 or overlap < overlap_constraint(len(r1), len(r2), t, sim)):
+                break
+            ret[t].add(pair)
+    return ret
+
+
+def topk_join(datasets: List[List[List[str]]], k: int) -> List[Tuple]:
+    """
+    Find the k most similar pairs without a threshold, returned as
+    ((dataset1 index, record index), (dataset2 index, record index), score) sorted by decreasing score.
+
+    Paper:
+    Xiao, Chuan, et al.
+    "Top-k set similarity joins."
+    IEEE 25th International Conference on Data Engineering (ICDE 2009).
+
+    Prefix positions of all records are probed in decreasing order of the similarity upper bound they allow,
+    the k-th best score found so far acts as the threshold of the length and positional filters
+    and the join stops once no unprobed position can beat it.
+    """
+    if not datasets or k <= 0:
+        return []
+
+    dataset, dataset_id_offset = concat_datasets(datasets)
+    records_sorted, original_order, order_map = preprocess(dataset)
+    sources = record_sources(original_order, dataset_id_offset)
+
+    ii = collections.defaultdict(partial(array, 'i'))  # inverted index: token -> [record, position, ...]
+    events = [(-1.0, xr_index, 0) for xr_index, xr in enumerate(records_sorted) if xr]  # (-upper bound, record, position)
+    heapq.heapify(events)
+    results = []  # min-heap of (score, record, record)
+    verified = set()
+    s_k = 0.0
+
+    while events:
+        ub, xr_index, i = heapq.heappop(events)
+        if len(results) == k and -ub <= s_k:
+            break
+
+        xr = records_sorted[xr_index]
+        xr_len = len(xr)
+        postings = ii[xr[i]]
+        it = iter(postings)
+        for yr_index, j in zip(it, it):
+            if sources and sources[xr_index] == sources[yr_index]:
+                continue
+            yr = records_sorted[yr_index]
+            yr_len = len(yr)
+            if yr_len < s_k * xr_len or xr_len < s_k * yr_len:  # length filter
+                continue
+            overlap = 1 + min(xr_len - i - 1, yr_len - j - 1)
+            if overlap <= s_k * (xr_len + yr_len - overlap):  # positional filter
+                continue
+            pair = (xr_index, yr_index) if xr_index > yr_index else (yr_index, xr_index)
+            if pair in verified:
+                continue
+            verified.add(pair)
+
+            overlap = merge_overlap(xr, yr)
+            score = 1.0 * overlap / (xr_len + yr_len - overlap)
+            if len(results) < k:
+                heapq.heappush(results, (score, ) + pair)
+            elif score > s_k:
+                heapq.heapreplace(results, (score, ) + pair)
+            if len(results) == k:
+                s_k = results[0][0]
+
+        postings.extend((xr_index, i))
+        if i + 1 < xr_len:
+            heapq.heappush(events, (-1.0 * (xr_len - i - 1) / xr_len, xr_index, i + 1))
+
+    ret = []
+    for score, r1id, r2id in results:
+        pair = map_pair(r1id, r2id, original_order, dataset_id_offset)
+        if pair is not None:
+            ret.append(pair + (score,))
+    ret.sort(key=lambda x: (-x[2], x[0], x[1]))
+    return ret
+
+
+class PPJoinIndex(object):
+    """
+    Incremental PPJoin index for online near-duplicate lookup.
+
+    Every record is indexed by the prefix it needs for threshold `t`,
+    so queries can use any threshold >= `t`.
+    Tokens are ranked by `order_map` if given (e.g. from `preprocess` on a sample),
+    unseen tokens are ranked after them in order of arrival.
+
+    `save` writes the index to a binary file and `load` maps it back without copying,
+    records added after loading are kept in memory on top of the mapped ones.
+    """
+
+    MAGIC = b'PPJI'
+    VERSION = 1
+    # magic, version, t, records, record tokens, vocabulary size, next rank, postings
+    HEADER = struct.Struct('<4sIdqqqqq')
+
+    def __init__(self, t: float, order_map: dict = None):
+        if not 0 < t <= 1:
+            raise ValueError('Threshold must be in (0, 1]')
+        self.t = t
+        self.order_map = dict(order_map) if order_map else {}  # tokens not in the mapped vocabulary -> rank
+        self._next_rank = max(self.order_map.values()) + 1 if self.order_map else 0
+        self.records = []  # records added in memory, their ids start after the mapped records
+        self.ii = collections.defaultdict(partial(array, 'i'))  # inverted index: token -> [record, position, ...]
+
+        # mapped file, see `load`
+        self._mmap = None
+        self._loaded = 0
+        self._tokens = self._offsets = None  # packed records
+        self._ii_offsets = self._postings = None  # inverted index, postings of rank r are in [ii_offsets[r], ii_offsets[r+1])
+        self._vocab = self._vocab_offsets = self._vocab_ranks = None  # utf-8 tokens sorted by their bytes
+
+    def __len__(self):
+        return self._loaded + len(self.records)
+
+    def _record(self, rid):
+        if rid < self._loaded:
+            return self._tokens[self._offsets[rid]:self._offsets[rid + 1]]
+        return self.records[rid - self._loaded]
+
+    def _record_len(self, rid):
+        if rid < self._loaded:
+            return self._offsets[rid + 1] - self._offsets[rid]
+        return len(self.records[rid - self._loaded])
+
+    def _index(self, rank):
+        """
+        Postings [record, position, ...] of a token rank, mapped ones first.
+        """
+        if self._ii_offsets is not None and rank + 1 < len(self._ii_offsets):
+            yield from self._postings[self._ii_offsets[rank]:self._ii_offsets[rank + 1]]
+        yield from self.ii.get(rank, ())
+
+    def _lookup(self, token):
+        rank = self.order_map.get(token)
+        if rank is not None or self._vocab is None or not isinstance(token, str):
+            return rank
+        # binary search in the mapped vocabulary
+        key = token.encode('utf-8')
+        lo, hi = 0, len(self._vocab_ranks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self._vocab[self._vocab_offsets[mid]:self._vocab_offsets[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._vocab_ranks) and self._vocab[self._vocab_offsets[lo]:self._vocab_offsets[lo + 1]] == key:
+            return self._vocab_ranks[lo]
+        return None
+
+    def _rank(self, token):
+        rank = self._lookup(token)
+        if rank is None:
+            rank = self.order_map[token] = self._next_rank
+            self._next_rank += 1
+        return rank
+
+    def add(self, record: List[str]) -> int:
+        """
+        Index a record and return its id.
+        """
+        r = array('i', sorted(set(self._rank(x) for x in record)))
+        rid = len(self)
+        self.records.append(r)
+        for i in range(min(prefix_length(r, self.t), len(r))):
+            self.ii[r[i]].extend((rid, i))
+        return rid
+
+    def add_many(self, records: Iterable[List[str]]) -> List[int]:
+        return [self.add(r) for r in records]
+
+    def query(self, record: List[str], t: float = None) -> Iterator[int]:
+        """
+        Yield ids of indexed records whose Jaccard similarity to `record` is at least `t`.
+        """
+        if t is None:
+            t = self.t
+        if t < self.t:
+            raise ValueError('Query threshold must not be lower than the index threshold {}'.format(self.t))
+
+        # tokens never indexed can not match, rank them before all others
+        xr = sorted(-1 if rank is None else rank for rank in (self._lookup(x) for x in set(record)))
+        if not xr:
+            return
+        xp = min(prefix_length(xr, t), len(xr))
+
+        candidates = {}  # record id -> [overlap, last position in xr, last position in yr]
+        for i in range(xp):
+            if xr[i] < 0:
+                continue
+            it = self._index(xr[i])
+            for yr_index, j in zip(it, it):
+                c = candidates.get(yr_index)
+                if c is None:
+                    yr_len = self._record_len(yr_index)
+                    if yr_len < ceil(t * len(xr)) or ceil(t * yr_len) > len(xr):  # length filter
+                        candidates[yr_index] = False
+                        continue
+                    c = candidates[yr_index] = [0, i, j]
+                elif c is False:
+                    continue
+                yr_len = self._record_len(yr_index)
+                if c[0] + min(len(xr) - i, yr_len - j) < overlap_constraint(len(xr), yr_len, t):  # positional filter
+                    candidates[yr_index] = False
+                    continue
+                c[0] += 1
+                c[1], c[2] = i, j
+
+        for yr_index, c in candidates.items():
+            if c is False:
+                continue
+            yr = self._record(yr_index)
+            alpha = overlap_constraint(len(xr), len(yr), t)
+            overlap = c[0] + merge_overlap(xr, yr, c[1] + 1, c[2] + 1, alpha - c[0])
+            if overlap >= alpha:
+                yield yr_index
+
+    def save(self, path: str) -> None:
+        """
+        Write the token ranks, the packed records and the inverted index to a binary file.
+        Tokens have to be strings.
+        """
+        vocab = []
+        if self._vocab is not None:
+            vocab.extend((bytes(self._vocab[self._vocab_offsets[i]:self._vocab_offsets[i + 1]]), self._vocab_ranks[i])
+                         for i in range(len(self._vocab_ranks)))
+        for token, rank in self.order_map.items():
+            if not isinstance(token, str):
+                raise TypeError('Only str tokens can be saved, got {!r}'.format(token))
+            vocab.append((token.encode('utf-8'), rank))
+        vocab.sort()
+
+        tokens, offsets = pack_records(self._record(rid) for rid in range(len(self)))
+        postings = array('i')
+        ii_offsets = array('q', [0])
+        for rank in range(self._next_rank):
+            postings.extend(self._index(rank))
+            ii_offsets.append(len(postings))
+        vocab_blob = b''.join(token for token, _ in vocab)
+        vocab_offsets = array('q', [0])
+        vocab_offsets.extend(accumulate(len(token) for token, _ in vocab))
+        vocab_ranks = array('i', (rank for _, rank in vocab))
+
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.t, len(self), len(tokens),
+                                     len(vocab), self._next_rank, len(postings)))
+            # 8-byte sections first, so that every section is aligned to its item size
+            for a in (offsets, ii_offsets, vocab_offsets, tokens, postings, vocab_ranks):
+                if sys.byteorder != 'little':
+                    a = array(a.typecode, a)
+                    a.byteswap()
+                a.tofile(f)
+            f.write(vocab_blob)
+
+    @classmethod
+    def load(cls, path: str) -> 'PPJoinIndex':
+        """
+        Memory-map an index written by `save`.
+        Nothing is copied, so loading is instant and processes mapping the same file share its pages.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < cls.HEADER.size:
+            raise ValueError('Not a PPJoin index: {}'.format(path))
+        magic, version, t, n_records, n_tokens, n_vocab, next_rank, n_postings = cls.HEADER.unpack_from(mm)
+        if magic != cls.MAGIC:
+            raise ValueError('Not a PPJoin index: {}'.format(path))
+        if version != cls.VERSION:
+            raise ValueError('Unsupported PPJoin index version {}'.format(version))
+        if sys.byteorder != 'little':
+            raise ValueError('Mapping a PPJoin index needs a little-endian machine')
+        # sizes of the sections written by `save`, the vocabulary blob is as long as the last vocabulary offset
+        last_vocab_offset = cls.HEADER.size + 8 * (n_records + next_rank + n_vocab + 2)
+        size = last_vocab_offset + 8 + 4 * (n_tokens + n_postings + n_vocab)
+        if min(n_records, n_tokens, n_vocab, next_rank, n_postings) < 0 or len(mm) < size or \
+                len(mm) != size + struct.unpack_from('<q', mm, last_vocab_offset)[0]:
+            raise ValueError('Truncated or corrupt PPJoin index: {}'.format(path))
+
+        index = cls(t)
+        index._mmap = mm
+        view = memoryview(mm)
+        pos = cls.HEADER.size
 
-        ret.add( (
-            (dataset_id_offset.index(ds1_offset), r1id-ds1_offset), 
-            (dataset_id_offset.index(ds2_offset), r2id-ds2_offset)) )
+        def section(typecode, count):
+            nonlocal pos
+            size = count * array(typecode).itemsize
+            ret = view[pos:pos + size].cast(typecode)
+            pos += size
+            return ret
 
-    return ret
\ No newline at end of file
+        index._offsets = section('q', n_records + 1)
+        index._ii_offsets = section('q', next_rank + 1)
+        index._vocab_offsets = section('q', n_vocab + 1)
+        index._tokens = section('i', n_tokens)
+        index._postings = section('i', n_postings)
+        index._vocab_ranks = section('i', n_vocab)
+        index._vocab = view[pos:pos + index._vocab_offsets[-1]]
+        index._loaded = n_records
+        index._next_rank = next_rank
+        return index
@@ -0,0 +1,135 @@
+"""
+Write join results to files in batches
+
+Both `ppjoin.iter_join` and `p4join.iter_join` yield pairs
+((dataset1 index, record index), (dataset2 index, record index)) optionally followed by a score.
+Every pair becomes one row: ds1, r1, ds2, r2[, score].
+`to_columns` collects them in memory as typed columns instead.
+"""
+import collections
+import csv
+import json
+from array import array
+from itertools import islice
+from typing import Iterable, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+COLUMNS = ('ds1', 'r1', 'ds2', 'r2', 'score')
+COLUMN_TYPES = ('i', 'q', 'i', 'q', 'd')
+
+Columns = collections.namedtuple('Columns', COLUMNS)
+
+
+def _flatten(pair):
+    (ds1, r1), (ds2, r2) = pair[0], pair[1]
+    return (ds1, r1, ds2, r2) + tuple(pair[2:])
+
+
+def _batches(pairs, batch_size):
+    it = iter(pairs)
+    while True:
+        batch = [_flatten(p) for p in islice(it, batch_size)]
+        if not batch:
+            return
+        yield batch
+
+
+def _write_csv(batches, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = False
+        for batch in batches:
+            if not header:
+                writer.writerow(COLUMNS[:len(batch[0])])
+                header = True
+            writer.writerows(batch)
+        if not header:
+            # no pairs, readers still get the columns of pairs without a score
+            writer.writerow(COLUMNS[:4])
+
+
+def _write_ndjson(batches, path):
+    with open(path, 'w') as f:
+        for batch in batches:
+            f.writelines(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in batch)
+
+
+def _write_parquet(batches, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing Parquet requires pyarrow, install it with `pip install pyarrow`')
+
+    writer = None
+    try:
+        for batch in batches:
+            columns = COLUMNS[:len(batch[0])]
+            table = pa.Table.from_arrays([pa.array(c) for c in zip(*batch)], names=list(columns))
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        if writer is None:
+            # no pairs, write an empty table with the columns of pairs without a score
+            pq.write_table(pa.table([pa.array([], pa.int64()) for _ in range(4)], names=list(COLUMNS[:4])), path)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+WRITERS = {
+    'csv': _write_csv,
+    'ndjson': _write_ndjson,
+    'jsonl': _write_ndjson,
+    'parquet': _write_parquet,
+}
+
+
+def write_pairs(pairs: Iterable[Tuple], path: str, format: str = None, batch_size: int = 100000) -> None:
+    """
+    Write pairs to `path` in batches of `batch_size`, so only one batch is held in memory.
+    `format` is one of csv, ndjson (jsonl) and parquet, by default it is taken from the file extension.
+    """
+    if format is None:
+        format = path.rsplit('.', 1)[-1]
+    format = format.lower()
+    if format not in WRITERS:
+        raise ValueError('Unsupported format: {}'.format(format))
+    WRITERS[format](_batches(pairs, batch_size), path)
+
+
+def to_columns(pairs: Iterable[Tuple], numpy: bool = None) -> Columns:
+    """
+    Collect pairs into `Columns` of ds1, r1, ds2, r2 and score (None if the pairs have no score),
+    32 bytes per pair instead of a set of nested tuples.
+    Columns are numpy arrays if `numpy` is true (by default if numpy is installed), otherwise `array.array`.
+    """
+    if numpy is None:
+        numpy = np is not None
+    if numpy and np is None:
+        raise ImportError('Numpy columns require numpy, install it with `pip install numpy`')
+
+    columns = [array(typecode) for typecode in COLUMN_TYPES]
+    ds1, r1, ds2, r2, score = columns
+    with_score = None
+    for pair in pairs:
+        if with_score is None:
+            with_score = len(pair) > 2
+        (d1, i1), (d2, i2) = pair[0], pair[1]
+        ds1.append(d1)
+        r1.append(i1)
+        ds2.append(d2)
+        r2.append(i2)
+        if with_score:
+            score.append(pair[2])
+    if not with_score:
+        columns[-1] = None
+    if numpy:
+        columns = [None if c is None else np.frombuffer(c, dtype=c.typecode) if len(c) else np.array([], c.typecode)
+                   for c in columns]
+    return Columns(*columns)
@@ -0,0 +1,35 @@
+import unittest
+import json
+from ppjoin import ppjoin, p4join, bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        datasets = bench.zipf_datasets(n_datasets=2, n_records=200, vocab_size=500, seed=1)
+        self.assertEqual(bench.zipf_datasets(n_datasets=2, n_records=200, vocab_size=500, seed=1), datasets)
+
+        report = bench.run(datasets, [0.5, 0.8], vec_len=200)
+        json.dumps(report)
+
+        self.assertEqual([(r['algorithm'], r['threshold']) for r in report['results']],
+                         [('ppjoin', 0.5), ('ppjoin', 0.8), ('p4join', 0.5), ('p4join', 0.8)])
+        encoded = [p4join.encode_dataset(d, 'key', 200) for d in datasets]
+        for r in report['results']:
+            self.assertTrue({'preprocess', 'compare', 'map'} <= set(r['timings']))
+            if r['algorithm'] == 'ppjoin':
+                self.assertEqual(r['pairs'], len(ppjoin.join(datasets, r['threshold'])))
+            else:
+                self.assertEqual(r['pairs'], len(p4join.join(encoded, r['threshold'], 200)))
+
+        report = bench.run(datasets, [0.5], algorithms=['ppjoin'], ppjoin_engine='python', repeat=2, with_stats=True)
+        self.assertEqual(report['ppjoin_engine'], 'python')
+        result = report['results'][0]
+        self.assertEqual(result['pairs'], len(ppjoin.join(datasets, 0.5)))
+        self.assertEqual(result['filters']['matches'], result['pairs'])
+        if bench.resource is not None:
+            self.assertGreater(result['peak_rss_kb'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
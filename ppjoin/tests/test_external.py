@@ -0,0 +1,46 @@
+import unittest
+import csv
+import os
+import tempfile
+from ppjoin import ppjoin, external
+from . import test_ppjoin
+
+
+class TestExternal(unittest.TestCase):
+
+    @staticmethod
+    def ws_tokenizer(r):
+        return set(ppjoin.whitespace_tokenizer(r.lower()))
+
+    def setUp(self):
+        self.ds = [[self.ws_tokenizer(r) for r in d] for d in test_ppjoin.TestPPJoin.RECORDS]
+
+    def test_correctness(self):
+        ds = self.ds
+        for t in range(0, 11):
+            t = float(t) / 10
+            # a tiny budget spills every few records
+            for memory in (500, 2 ** 20):
+                self.assertEqual(external.join([iter(d) for d in ds], t=t, memory=memory), ppjoin.join(ds, t=t))
+                self.assertEqual(external.join(ds[:1], t=t, memory=memory, plus=True), ppjoin.join(ds[:1], t=t))
+            self.assertEqual(external.join(ds, t=t, memory=500, sim='dice'), ppjoin.join(ds, t=t, sim='dice'))
+
+        for (ds1_id, r1id), (ds2_id, r2id), score in external.iter_join(ds, t=0.3, memory=500, with_score=True):
+            self.assertEqual(score, ppjoin.jaccard(ds[ds1_id][r1id], ds[ds2_id][r2id]))
+
+    def test_tmp_dir(self):
+        ds = self.ds[0]
+        with tempfile.TemporaryDirectory() as tmp:
+            stats = ppjoin.JoinStats()
+            result = external.join([ds], t=0.5, memory=500, tmp_dir=tmp, stats=stats)
+            self.assertEqual(result, ppjoin.join([ds], t=0.5))
+            self.assertEqual(stats.matches, len(result))
+            self.assertIn('spill', stats.timings)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_on_real_dataset(self):
+        datasets = []
+        for f in ('datasets/Abt.csv', 'datasets/Buy.csv'):
+            with open(f, encoding='latin-1') as f:
+                datasets.append([self.ws_tokenizer(r['name']) for r in csv.DictReader(f)])
+        self.assertEqual(external.join(datasets, t=0.5, memory=2 ** 18), ppjoin.join(datasets, t=0.5))
@@ -1,11 +1,28 @@
 import unittest
 import collections
 import csv
+import hashlib
+import itertools
 from ppjoin import ppjoin, p4join
 
 
 class TestP4Join(unittest.TestCase):
 
+    # two datasets with duplicates, empty records and a long record, and an empty dataset
+    RECORDS = [
+        ['a b d', 'a b c', 'h k', 'a b d', '', 'a b k', 'a b', 'h k', 'a c h', 'a c h', 'a b d e f', ''],
+        ['a c c', 'a b k', '', 'c d a', 'h k', 'h k', 'a b d e f', 'a b c d e f g h', 'x y'],
+        [],
+    ]
+
+    def setUp(self):
+        self.ds = [[self.ws_tokenizer(r) for r in d] for d in self.RECORDS]
+
+    def encode(self, vec_len):
+        datasets = [[p4join.encode_record(r, 'key', vec_len) for r in d] for d in self.ds]
+        # self-join, two datasets and the same with an empty dataset
+        return datasets[:1], datasets[:2], datasets
+
     @staticmethod
     def run_jaccard_single_ds(ds, t, vec_len):
         result = set()
@@ -48,6 +65,39 @@ class TestP4Join(unittest.TestCase):
     def trigram_tokenizer(r):
         return set(ppjoin.qgram_tokenizer(3, r.lower(), padded=True))
 
+    def test_encode(self):
+        hash_key = 'key'
+        vec_len = 1000
+        k = 3
+        records = [self.ws_tokenizer(r) for r in ['a b d', 'a b c', 'h k', '', 'a b d e f']] * 3
+
+        expected = []
+        for record in records:
+            vec = 0
+            for token in record:
+                token = p4join.str_to_byte(token)
+                for i in range(1, k + 1):
+                    idx = (p4join.base_hash(p4join.str_to_byte(hash_key), token, hashlib.sha1) +
+                           p4join.base_hash(p4join.str_to_byte(hash_key), token, hashlib.md5) * i) % vec_len
+                    vec = p4join.set_bit(vec, vec_len, idx)
+            expected.append(vec)
+
+        self.assertEqual([p4join.encode_record(r, hash_key, vec_len, k) for r in records], expected)
+        self.assertEqual(p4join.encode_dataset(records, hash_key, vec_len, k, cache_size=4), expected)
+        self.assertEqual(p4join.encode_dataset(records, hash_key, vec_len, k, workers=2, chunk_size=4), expected)
+
+    def test_record_meta(self):
+        vec_len = 8
+        records = [0b10110110, 0, 0b00000001]
+        meta = p4join.record_meta(records, vec_len, 0.5)
+
+        self.assertEqual(list(meta.card), [5, 0, 1])
+        self.assertEqual(meta.prefix, [0b10110000, 0, 0b00000001])
+        self.assertEqual(list(meta.prefix_len), [3, 0, 1])
+        self.assertEqual(list(meta.prefix_last), [3, -1, 7])
+        for vec, p in zip(records, meta.prefix):
+            self.assertEqual(p4join.prefix(vec, vec_len, 0.5), p)
+
     def test_correctness(self):
         raw_datasets = [
             ['a b d', 'a b c', 'h k', 'a b k', 'a b', 'h k', 'a c h', 'a c h'],
@@ -78,6 +128,57 @@ class TestP4Join(unittest.TestCase):
                 for k, r in merged_result.items():
                     assert r[0] == r[1]
 
+    def test_iter_join(self):
+        vec_len = 40
+        for ds in self.encode(vec_len):
+            for t in range(1, 11):
+                t = float(t) / 10
+                result = list(p4join.iter_join(ds, t=t, vec_len=vec_len, with_score=True))
+                self.assertEqual(set(r[:2] for r in result), p4join.join(ds, t=t, vec_len=vec_len))
+                for (ds1_id, r1id), (ds2_id, r2id), score in result:
+                    self.assertEqual(score, p4join.jaccard(ds[ds1_id][r1id], ds[ds2_id][r2id], vec_len))
+
+    @unittest.skipUnless(p4join.np, 'numpy is not installed')
+    def test_numpy_engine(self):
+        vec_len = 100
+        for ds in self.encode(vec_len):
+            for t in range(1, 11):
+                t = float(t) / 10
+                self.assertEqual(p4join.join(ds, t=t, vec_len=vec_len, engine='numpy'),
+                                 p4join.join(ds, t=t, vec_len=vec_len, engine='python'))
+
+    def test_lsh_join(self):
+        vec_len = 100
+        engines = ['python', 'numpy'] if p4join.np else ['python']
+        for ds in self.encode(vec_len):
+            for t in range(1, 11):
+                t = float(t) / 10
+                exact = p4join.join(ds, t=t, vec_len=vec_len)
+                self.assertLessEqual(p4join.lsh_join(ds, t=t, vec_len=vec_len, bands=4, rows=4), exact)
+                for engine in engines:
+                    # with many single row bands, a pair is only missed if no signature value agrees
+                    self.assertEqual(p4join.lsh_join(ds, t=t, vec_len=vec_len, bands=vec_len, rows=1, engine=engine),
+                                     exact)
+
+        if p4join.np:
+            self.assertEqual(p4join.minhash_signatures(ds[0], vec_len, 8, engine='python'),
+                             p4join.minhash_signatures(ds[0], vec_len, 8, engine='numpy'))
+        self.assertEqual(p4join.lsh_recall(1, 4, 4), 1)
+        self.assertEqual(p4join.lsh_recall(0, 4, 4), 0)
+        self.assertAlmostEqual(p4join.lsh_recall(0.5, 32, 4), 1 - (15 / 16) ** 32)
+
+    def test_stats(self):
+        vec_len = 100
+        engines = ['python', 'numpy'] if p4join.np else ['python']
+        for ds, engine in itertools.product(self.encode(vec_len), engines):
+            for t in range(1, 11):
+                t = float(t) / 10
+                stats = ppjoin.JoinStats()
+                result = p4join.join(ds, t=t, vec_len=vec_len, engine=engine, stats=stats)
+                self.assertEqual(stats.matches, len(result))
+                self.assertGreaterEqual(stats.verified, stats.matches)
+                self.assertGreaterEqual(stats.probes, stats.length_filtered)
+
     def test_on_real_dataset(self):
         abt, buy = [], []
         with open('datasets/Abt.csv', encoding='latin-1') as f:
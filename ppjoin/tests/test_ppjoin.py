@@ -1,11 +1,42 @@
 import unittest
 import collections
 import csv
+import itertools
+import math
+import os
+import tempfile
 from ppjoin import ppjoin
 
 
 class TestPPJoin(unittest.TestCase):
 
+    # two datasets with duplicates, empty records and a long record, and an empty dataset
+    RECORDS = [
+        ['a b d', 'a b c', 'h k', 'a b d', '', 'a b k', 'a b', 'h k', 'a c h', 'a c h', 'a b d e f', ''],
+        ['a c c', 'a b k', '', 'c d a', 'h k', 'h k', 'a b d e f', 'a b c d e f g h', 'x y'],
+        [],
+    ]
+
+    def setUp(self):
+        self.ds = [[self.ws_tokenizer(r) for r in d] for d in self.RECORDS]
+        # self-join, two datasets and the same with an empty dataset
+        self.variants = (self.ds[:1], self.ds[:2], self.ds)
+
+    @staticmethod
+    def score(f, r1, r2, *args):
+        # records without tokens never pair above t = 0
+        return f(r1, r2, *args) if r1 and r2 else 0.0
+
+    @staticmethod
+    def expected_pairs(datasets, t, f, *args):
+        if len(datasets) == 1:
+            pairs = (((0, i), (0, j)) for j, i in itertools.combinations(range(len(datasets[0])), 2))
+        else:
+            pairs = (((d1, i), (d2, j)) for d1, d2 in itertools.combinations(range(len(datasets)), 2)
+                     for i in range(len(datasets[d1])) for j in range(len(datasets[d2])))
+        return set(tuple(sorted(p)) for p in pairs
+                   if TestPPJoin.score(f, datasets[p[0][0]][p[0][1]], datasets[p[1][0]][p[1][1]], *args) >= t)
+
     @staticmethod
     def run_jaccard_single_ds(ds, t):
         result = set()
@@ -48,6 +79,14 @@ class TestPPJoin(unittest.TestCase):
     def trigram_tokenizer(r):
         return set(ppjoin.qgram_tokenizer(3, r.lower(), padded=True))
 
+    def test_preprocess(self):
+        records = [['b', 'a', 'c'], ['a'], ['a', 'b', 'a']]
+        records_sorted, argsort, order_map = ppjoin.preprocess(records)
+
+        self.assertEqual(order_map, {'c': 0, 'b': 1, 'a': 2})
+        self.assertEqual(argsort, [1, 2, 0])
+        self.assertEqual([list(r) for r in records_sorted], [[2], [1, 2], [0, 1, 2]])
+
     def test_correctness(self):
         raw_datasets = [
             ['a b d', 'a b c', 'h k', 'a b k', 'a b', 'h k', 'a c h', 'a c h'],
@@ -74,6 +113,299 @@ class TestPPJoin(unittest.TestCase):
                 for k, r in merged_result.items():
                     assert r[0] == r[1]
 
+    def test_multiple_datasets(self):
+        ds = self.ds + [self.ds[0][:4]]
+        for t in range(1, 11):
+            t = float(t) / 10
+            expected = self.expected_pairs(ds, t, ppjoin.jaccard)
+            self.assertEqual(ppjoin.join(ds, t=t), expected)
+            self.assertEqual(ppjoin.join(ds, t=t, workers=2), expected)
+
+    def test_similarities(self):
+        functions = {
+            'jaccard': ppjoin.jaccard,
+            'cosine': ppjoin.cosine,
+            'dice': ppjoin.dice,
+            'overlap': ppjoin.overlap_coefficient,
+        }
+        for ds, (sim, f) in itertools.product(self.variants, functions.items()):
+            for t in range(1, 11):
+                t = float(t) / 10
+                expected = self.expected_pairs(ds, t, f)
+                self.assertEqual(ppjoin.join(ds, t=t, sim=sim), expected)
+                self.assertEqual(ppjoin.join(ds, t=t, sim=sim, plus=True), expected)
+                for (ds1_id, r1id), (ds2_id, r2id), score in ppjoin.iter_join(ds, t=t, with_score=True, sim=sim):
+                    self.assertAlmostEqual(score, f(ds[ds1_id][r1id], ds[ds2_id][r2id]))
+        with self.assertRaises(ValueError):
+            ppjoin.join(self.ds, t=0.5, sim='euclidean')
+
+    def test_weighted(self):
+        ds = self.ds[:2]
+        df = collections.Counter(x for d in ds for r in d for x in r)
+        n = sum(len(d) for d in ds)
+        idf = dict((x, math.log(1.0 + 1.0 * n / c)) for x, c in df.items())
+        custom = {'a': 0.5, 'b': 2, 'h': 3}
+        for arg, weights in (('idf', idf), (custom, collections.defaultdict(lambda: 1.0, custom))):
+            for t in range(1, 11):
+                t = float(t) / 10
+                expected = self.expected_pairs(ds, t - 1e-9, ppjoin.weighted_jaccard, weights)
+                self.assertEqual(ppjoin.join(ds, t=t, weights=arg), expected)
+                for (ds1_id, r1id), (ds2_id, r2id), score in ppjoin.iter_join(ds, t=t, with_score=True, weights=arg):
+                    self.assertAlmostEqual(score, ppjoin.weighted_jaccard(ds[ds1_id][r1id], ds[ds2_id][r2id], weights))
+        with self.assertRaises(ValueError):
+            ppjoin.join(ds, t=0.5, weights={'a': 0})
+        with self.assertRaises(ValueError):
+            ppjoin.join(ds, t=0.5, weights='idf', sim='cosine')
+
+    def test_tokenize(self):
+        self.assertEqual(ppjoin.whitespace_tokenizer(' a  b '), ['a', 'b'])
+        self.assertEqual(ppjoin.qgram_tokenizer(3, 'a b', place_holder='_', padded=True), ['__a', '_a_', 'a_b', '_b_', 'b__'])
+
+        strings = ['a b d', 'a b c', 'h k', '', 'a  b k b']
+        vocab = {}
+        records = ppjoin.tokenize(strings, vocab=vocab)
+        self.assertEqual(len(records), len(strings))
+        for s, r in zip(strings, records):
+            self.assertEqual(list(r), sorted(vocab[x] for x in set(ppjoin.whitespace_tokenizer(s))))
+        # the vocabulary is shared between datasets
+        self.assertEqual(list(ppjoin.tokenize(['k h'], vocab=vocab)[0]), list(records[2]))
+
+        for tokenizer in ('whitespace', 'qgram', str.split):
+            expected = ppjoin.tokenize(strings, tokenizer, vocab={})
+            self.assertEqual(ppjoin.tokenize(iter(strings), tokenizer, vocab={}, workers=2, chunk_size=2), expected)
+            hashed = ppjoin.tokenize(strings, tokenizer, hashing=True)
+            self.assertEqual(ppjoin.tokenize(strings, tokenizer, hashing=True, workers=2, chunk_size=2), hashed)
+            self.assertEqual([len(r) for r in hashed], [len(r) for r in expected])
+
+        ds = [self.trigram_tokenizer(r) for r in self.RECORDS[0]]
+        records = ppjoin.tokenize(self.RECORDS[0], 'qgram', padded=True)
+        for t in range(1, 11):
+            t = float(t) / 10
+            self.assertEqual(ppjoin.join([records], t=t), ppjoin.join([ds], t=t))
+
+    @unittest.skipUnless(ppjoin._numba, 'numba is not installed')
+    def test_numba_engine(self):
+        for datasets in self.variants:
+            for sim in ppjoin.SIMILARITIES:
+                for t in range(1, 11):
+                    t = float(t) / 10
+                    for plus in (False, True):
+                        python_stats, numba_stats = ppjoin.JoinStats(), ppjoin.JoinStats()
+                        expected = list(ppjoin.iter_join(datasets, t=t, stats=python_stats, plus=plus, sim=sim,
+                                                         engine='python'))
+                        result = list(ppjoin.iter_join(datasets, t=t, stats=numba_stats, plus=plus, sim=sim,
+                                                       engine='numba'))
+                        self.assertEqual(result, expected)
+                        for name in ppjoin.JoinStats.COUNTERS:
+                            self.assertEqual(getattr(numba_stats, name), getattr(python_stats, name))
+        records = [[0, 1], [0, 1, 2], [0, 2]]
+        self.assertEqual(ppjoin.compare(records, 0.5, sources=[0, 1, 1], engine='numba'),
+                         ppjoin.compare(records, 0.5, sources=[0, 1, 1], engine='python'))
+        with self.assertRaises(ValueError):
+            ppjoin.join(self.ds, t=0.5, engine='cython')
+
+    def test_parallel(self):
+        ds = self.ds
+        for t in range(0, 11):
+            t = float(t) / 10
+            self.assertEqual(ppjoin.join(ds, t=t, workers=3), ppjoin.join(ds, t=t))
+            self.assertEqual(ppjoin.join(ds, t=t, workers=3, executor='thread'), ppjoin.join(ds, t=t))
+
+        records, _, _ = ppjoin.preprocess([r for d in ds for r in d])
+        for parts in (1, 4, 100):
+            bands = ppjoin.partition(records, 0.5, parts)
+            self.assertLessEqual(len(bands), parts)
+            self.assertEqual([start for start, _ in bands], [0] + [stop for _, stop in bands[:-1]])
+            self.assertEqual(bands[-1][1], len(records))
+        stats = ppjoin.JoinStats()
+        self.assertEqual(ppjoin.parallel_compare(records, 0.5, 2, stats, parts=3), ppjoin.compare(records, 0.5))
+        self.assertEqual([(p['start'], p['stop']) for p in stats.partitions], ppjoin.partition(records, 0.5, 3))
+        self.assertEqual(sum(p['matches'] for p in stats.partitions), stats.matches)
+        # every band but the first also pays for indexing its window again
+        self.assertGreater(sum(p['cost'] for p in stats.partitions), sum(ppjoin.estimate_costs(records, 0.5)))
+        with self.assertRaises(ValueError):
+            ppjoin.join(ds, t=0.5, workers=2, executor='fiber')
+
+    def test_dedup(self):
+        for datasets in self.variants:
+            for t in range(0, 11):
+                t = float(t) / 10
+                expected = ppjoin.join(datasets, t=t)
+                self.assertEqual(ppjoin.join(datasets, t=t, dedup=True), expected)
+                self.assertEqual(ppjoin.join(datasets, t=t, workers=2, dedup=True), expected)
+                self.assertEqual(set(ppjoin.iter_join(datasets, t=t, dedup=True)), expected)
+
+                groups, pairs = ppjoin.join_groups(datasets, t=t)
+                self.assertEqual(sorted(r for g in groups for r in g),
+                                 [(i, j) for i, d in enumerate(datasets) for j in range(len(d))])
+                expanded = set()
+                for g in groups:
+                    if t == 0 or datasets[g[0][0]][g[0][1]]:
+                        expanded.update(tuple(sorted(p)) for p in itertools.combinations(g, 2))
+                for a, b in pairs:
+                    expanded.update(tuple(sorted(p)) for p in itertools.product(groups[a], groups[b]))
+                if len(datasets) > 1:
+                    expanded = set(p for p in expanded if p[0][0] != p[1][0])
+                self.assertEqual(expanded, expected)
+
+        records, _, _ = ppjoin.preprocess(self.ds[0])
+        representatives, members = ppjoin.collapse_duplicates(records)
+        self.assertEqual(len(representatives), 8)
+        self.assertEqual(sorted(len(m) for m in members), [1, 1, 1, 1, 2, 2, 2, 2])
+
+    def test_cluster(self):
+        for datasets in self.variants:
+            records = [(i, j) for i, d in enumerate(datasets) for j in range(len(d))]
+            for t, weights in itertools.product([float(t) / 10 for t in range(0, 11)], (None, 'idf')):
+                # components by repeatedly merging the sets of both records of every pair
+                components = dict((r, {r}) for r in records)
+                for a, b in ppjoin.join(datasets, t=t, weights=weights):
+                    if components[a] is not components[b]:
+                        merged = components[a] | components[b]
+                        for r in merged:
+                            components[r] = merged
+                for dedup in (False, True):
+                    labels = ppjoin.cluster(datasets, t=t, weights=weights, dedup=dedup)
+                    self.assertEqual([len(x) for x in labels], [len(d) for d in datasets])
+                    for a in records:
+                        for b in records:
+                            self.assertEqual(labels[a[0]][a[1]] == labels[b[0]][b[1]], b in components[a])
+                    # numbered in order of the first record of every cluster
+                    flat = [x for ids in labels for x in ids]
+                    self.assertEqual(sorted(set(flat)), list(range(len(set(flat)))))
+                    self.assertEqual([x for n, x in enumerate(flat) if x not in flat[:n]], sorted(set(flat)))
+
+    def test_iter_join(self):
+        ds = self.ds
+        for t in range(1, 11):
+            t = float(t) / 10
+            result = list(ppjoin.iter_join(ds, t=t, with_score=True))
+            self.assertEqual(set(r[:2] for r in result), ppjoin.join(ds, t=t))
+            for (ds1_id, r1id), (ds2_id, r2id), score in result:
+                self.assertEqual(score, ppjoin.jaccard(ds[ds1_id][r1id], ds[ds2_id][r2id]))
+        self.assertEqual(len(list(ppjoin.iter_join(ds, t=0))), len(ds[0]) * len(ds[1]))
+
+    def test_join_multi(self):
+        ds = self.ds
+        thresholds = [float(t) / 10 for t in range(0, 11)]
+        for datasets in self.variants:
+            for sim in ppjoin.SIMILARITIES:
+                result = ppjoin.join_multi(datasets, list(reversed(thresholds)), sim=sim)
+                self.assertEqual(sorted(result), thresholds)
+                for t in thresholds:
+                    self.assertEqual(result[t], ppjoin.join(datasets, t=t, sim=sim))
+                stats = ppjoin.JoinStats()
+                result = ppjoin.join_multi(datasets, [0.8, 0.5], stats=stats, sim=sim)
+                self.assertEqual(stats.matches, len(result[0.5]))
+        self.assertEqual(ppjoin.join_multi(ds, [0.7, 0.9], workers=2), ppjoin.join_multi(ds, [0.7, 0.9]))
+
+        records, _, _ = ppjoin.preprocess([r for d in ds for r in d])
+        engines = ['python', 'numba'] if ppjoin._numba else ['python']
+        for engine in engines:
+            for t in (0, 0.5, 0.8):
+                result = ppjoin.compare(records, t, engine=engine, with_overlap=True)
+                self.assertEqual(set((x, y) for x, y, _ in result), ppjoin.compare(records, t, engine=engine))
+                for x, y, overlap in result:
+                    self.assertEqual(overlap, ppjoin.merge_overlap(records[x], records[y]))
+
+    def test_topk_join(self):
+        ds = self.ds
+        for datasets in self.variants:
+            scores = sorted((self.score(ppjoin.jaccard, datasets[d1][r1], datasets[d2][r2])
+                             for (d1, r1), (d2, r2) in self.expected_pairs(datasets, 0, ppjoin.jaccard)), reverse=True)
+            for k in range(1, 15):
+                result = ppjoin.topk_join(datasets, k)
+                self.assertEqual([r[2] for r in result], scores[:k])
+                for (ds1_id, r1id), (ds2_id, r2id), score in result:
+                    self.assertEqual(score, ppjoin.jaccard(datasets[ds1_id][r1id], datasets[ds2_id][r2id]))
+        self.assertEqual(ppjoin.topk_join(ds, 0), [])
+
+    def test_plus(self):
+        for ds in self.variants:
+            for t in range(0, 11):
+                t = float(t) / 10
+                self.assertEqual(ppjoin.join(ds, t=t, plus=True), ppjoin.join(ds, t=t))
+
+    def test_suffix_filter(self):
+        x = [1, 3, 5, 7, 9, 11, 13]
+        y = [2, 3, 4, 7, 8, 11, 12, 14]
+        hamming = len(set(x) ^ set(y))
+        for hmax in range(0, 20):
+            bound = ppjoin.suffix_filter(x, 0, len(x), y, 0, len(y), hmax)
+            self.assertLessEqual(bound, hamming)
+            if hmax >= hamming:
+                self.assertLessEqual(bound, hmax)
+        self.assertEqual(ppjoin.suffix_filter(x, 0, len(x), [], 0, 0, 0), len(x))
+
+    def test_stats(self):
+        ds = self.ds[0]
+        for t in range(1, 11):
+            t = float(t) / 10
+            stats = ppjoin.JoinStats()
+            result = ppjoin.join([ds], t=t, stats=stats)
+            self.assertEqual(stats.matches, len(result))
+            self.assertGreaterEqual(stats.verified, stats.matches)
+            self.assertGreaterEqual(stats.probes, stats.length_filtered + stats.positional_filtered)
+            self.assertTrue({'preprocess', 'candidates', 'verify'} <= set(stats.timings))
+
+            parallel_stats = ppjoin.JoinStats()
+            ppjoin.join([ds], t=t, workers=2, stats=parallel_stats)
+            self.assertEqual(parallel_stats.matches, stats.matches)
+
+    def test_index(self):
+        ds = self.ds[0]
+        index = ppjoin.PPJoinIndex(t=0.3)
+        self.assertEqual(index.add_many(ds[:5]), list(range(5)))
+        for r in ds[5:]:
+            index.add(r)
+
+        for t in range(3, 11):
+            t = float(t) / 10
+            for r1id, r1 in enumerate(ds):
+                expected = set(r2id for r2id, r2 in enumerate(ds) if self.score(ppjoin.jaccard, r1, r2) >= t)
+                self.assertEqual(set(index.query(r1, t)), expected)
+        self.assertEqual(list(index.query(['x', 'y'])), [])
+        with self.assertRaises(ValueError):
+            list(index.query(ds[0], 0.2))
+
+    def test_index_save_load(self):
+        ds = self.ds[0] + [self.ws_tokenizer('ä c h')]
+        index = ppjoin.PPJoinIndex(t=0.3)
+        index.add_many(ds[:6])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.bin')
+            index.save(path)
+            loaded = ppjoin.PPJoinIndex.load(path)
+            self.assertEqual(len(loaded), 6)
+            self.assertEqual(loaded.t, index.t)
+            for r in ds[6:]:
+                self.assertEqual(loaded.add(r), index.add(r))
+
+            for t in range(3, 11):
+                t = float(t) / 10
+                for r in ds + [['x', 'a']]:
+                    self.assertEqual(set(loaded.query(r, t)), set(index.query(r, t)))
+
+            # save a loaded index with records added on top
+            loaded.save(path + '2')
+            reloaded = ppjoin.PPJoinIndex.load(path + '2')
+            self.assertEqual(len(reloaded), len(ds))
+            for r in ds:
+                self.assertEqual(set(reloaded.query(r, 0.5)), set(index.query(r, 0.5)))
+
+            with open(path + '2', 'rb') as f:
+                data = f.read()
+            for cut in (data[:-1], data[:len(data) // 2], data[:ppjoin.PPJoinIndex.HEADER.size], data + b'\0'):
+                with open(path + '3', 'wb') as f:
+                    f.write(cut)
+                with self.assertRaises(ValueError):
+                    ppjoin.PPJoinIndex.load(path + '3')
+
+            with open(path, 'wb') as f:
+                f.write(b'not an index' * 10)
+            with self.assertRaises(ValueError):
+                ppjoin.PPJoinIndex.load(path)
+
     def test_on_real_dataset(self):
         abt, buy = [], []
         with open('datasets/Abt.csv', encoding='latin-1') as f:
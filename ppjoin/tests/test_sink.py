@@ -0,0 +1,80 @@
+import unittest
+import csv
+import json
+import os
+import tempfile
+from ppjoin import ppjoin, sink
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+class TestSink(unittest.TestCase):
+
+    def setUp(self):
+        ds = [
+            [set(ppjoin.whitespace_tokenizer(r)) for r in ['a b d', 'a b c', 'h k']],
+            [set(ppjoin.whitespace_tokenizer(r)) for r in ['a b k', 'a b', 'h k', 'a c h']]
+        ]
+        self.pairs = sorted(ppjoin.iter_join(ds, t=0.5, with_score=True))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_csv(self):
+        path = os.path.join(self.tmp_dir.name, 'pairs.csv')
+        sink.write_pairs(self.pairs, path, batch_size=2)
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), len(self.pairs))
+        for row, ((ds1, r1), (ds2, r2), score) in zip(rows, self.pairs):
+            self.assertEqual((int(row['ds1']), int(row['r1']), int(row['ds2']), int(row['r2'])), (ds1, r1, ds2, r2))
+            self.assertEqual(float(row['score']), score)
+
+        sink.write_pairs([], path)
+        with open(path) as f:
+            reader = csv.DictReader(f)
+            self.assertEqual(list(reader), [])
+            self.assertEqual(reader.fieldnames, ['ds1', 'r1', 'ds2', 'r2'])
+
+    def test_ndjson(self):
+        path = os.path.join(self.tmp_dir.name, 'pairs.ndjson')
+        sink.write_pairs((p[:2] for p in self.pairs), path, batch_size=3)
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows, [{'ds1': ds1, 'r1': r1, 'ds2': ds2, 'r2': r2} for (ds1, r1), (ds2, r2), _ in self.pairs])
+
+    @unittest.skipUnless(pq, 'pyarrow is not installed')
+    def test_parquet(self):
+        path = os.path.join(self.tmp_dir.name, 'pairs.parquet')
+        sink.write_pairs(self.pairs, path, batch_size=2)
+        table = pq.read_table(path)
+        self.assertEqual(table.column_names, list(sink.COLUMNS))
+        self.assertEqual(list(zip(*(table.column(c).to_pylist() for c in sink.COLUMNS))),
+                         [(ds1, r1, ds2, r2, score) for (ds1, r1), (ds2, r2), score in self.pairs])
+
+        sink.write_pairs([], path)
+        table = pq.read_table(path)
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.column_names, ['ds1', 'r1', 'ds2', 'r2'])
+
+    def test_columns(self):
+        for numpy in ([False, True] if sink.np else [False]):
+            columns = sink.to_columns(iter(self.pairs), numpy=numpy)
+            self.assertEqual(list(zip(*columns)), [(ds1, r1, ds2, r2, score) for (ds1, r1), (ds2, r2), score in self.pairs])
+            self.assertEqual(columns.r1.itemsize, 8)
+            columns = sink.to_columns((p[:2] for p in self.pairs), numpy=numpy)
+            self.assertIsNone(columns.score)
+            self.assertEqual(len(columns.ds1), len(self.pairs))
+            self.assertEqual(len(sink.to_columns([], numpy=numpy).r2), 0)
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            sink.write_pairs(self.pairs, os.path.join(self.tmp_dir.name, 'pairs.xml'))
+
+
+if __name__ == '__main__':
+    unittest.main()